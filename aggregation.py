@@ -0,0 +1,144 @@
+import json
+import math
+
+from psycopg2 import sql
+
+# Tables estimated to return more features than this are rendered as grid counts
+DEFAULT_FEATURE_THRESHOLD = 5000
+
+# Features of all tables of one request sent to the browser; tables that would go beyond it
+# are rendered as grid counts too
+DEFAULT_TOTAL_FEATURE_THRESHOLD = 20000
+
+# Number of grid cells across the longer side of the queried area
+GRID_CELLS = 50
+
+# Cell size (degrees) when everything is queried and there is no polygon to size the grid from
+DEFAULT_CELL_SIZE = 0.01
+
+# Zoom level from which aggregated tables are drilled down to raw features in the current view
+DEFAULT_DRILL_DOWN_ZOOM = 14
+
+# How hit counts are estimated: planner statistics, or a count capped just above the threshold
+ESTIMATE_PLANNER = 'planner'
+ESTIMATE_COUNT = 'count'
+
+# Rows of a table according to its statistics; None before it was ever analyzed
+def table_row_count(conn, table_name):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass;',
+            (sql.Identifier('public', table_name).as_string(conn),),
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+# Estimate how many rows of a table match a WHERE clause, without fetching them. The clause is
+# composable SQL whose placeholders are bound from params.
+def estimate_rows(conn, table_name, where, method=ESTIMATE_PLANNER, threshold=DEFAULT_FEATURE_THRESHOLD, params=None):
+    table = sql.Identifier('public', table_name)
+    with conn.cursor() as cursor:
+        if method == ESTIMATE_COUNT:
+            # The LIMIT stops the scan as soon as the threshold is known to be exceeded
+            cursor.execute(sql.SQL("""
+                SELECT count(*) FROM (
+                    SELECT 1 FROM {} WHERE {} LIMIT {}
+                ) hits;
+            """).format(table, where, sql.Literal(int(threshold) + 1)), params)
+            return cursor.fetchone()[0]
+        cursor.execute(sql.SQL('EXPLAIN (FORMAT JSON) SELECT 1 FROM {} WHERE {};').format(table, where), params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+# Bounds (west, south, east, north) of a GeoJSON geometry
+def geojson_bounds(geometry):
+    def iter_positions(coordinates):
+        if isinstance(coordinates[0], (int, float)):
+            yield coordinates
+        else:
+            for item in coordinates:
+                yield from iter_positions(item)
+
+    positions = list(iter_positions(geometry['coordinates']))
+    xs = [position[0] for position in positions]
+    ys = [position[1] for position in positions]
+    return min(xs), min(ys), max(xs), max(ys)
+
+# Grid cell size for the queried area, in degrees
+def cell_size_for(polygon_geojson):
+    if polygon_geojson is None:
+        return DEFAULT_CELL_SIZE
+    west, south, east, north = geojson_bounds(json.loads(polygon_geojson))
+    return max(east - west, north - south, 1e-6) / GRID_CELLS
+
+# Count the matching features of a table per grid cell on the server, returned as a GeoJSON FeatureCollection
+def fetch_grid_counts(conn, table_name, where, geometry_expression, cell_size, params=None):
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            SELECT floor(ST_X(point) / {cell_size}) AS gx, floor(ST_Y(point) / {cell_size}) AS gy, count(*)
+            FROM (
+                SELECT ST_PointOnSurface({geometry}) AS point
+                FROM {table}
+                WHERE {where}
+            ) features
+            GROUP BY 1, 2;
+        """).format(
+            cell_size=sql.Literal(float(cell_size)),
+            geometry=geometry_expression,
+            table=sql.Identifier('public', table_name),
+            where=where,
+        ), params)
+        rows = cursor.fetchall()
+    return grid_feature_collection(rows, cell_size)
+
+# Count points per grid cell in Python, as fetch_grid_counts does on the server
+def count_points(xs, ys, cell_size):
+    counts = {}
+    for x, y in zip(xs, ys):
+        cell = (math.floor(x / cell_size), math.floor(y / cell_size))
+        counts[cell] = counts.get(cell, 0) + 1
+    return grid_feature_collection([(gx, gy, count) for (gx, gy), count in counts.items()], cell_size)
+
+# GeoJSON FeatureCollection of (gx, gy, count) grid cells
+def grid_feature_collection(rows, cell_size):
+    features = []
+    for gx, gy, count in rows:
+        west, south = gx * cell_size, gy * cell_size
+        east, north = west + cell_size, south + cell_size
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]},
+            'properties': {'count': count},
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+# Add grid counts to a map as a choropleth layer
+def add_aggregate_layer(feature_collection, table_name, map_object):
+    import branca.colormap
+    import folium
+
+    counts = [feature['properties']['count'] for feature in feature_collection['features']]
+    if not counts:
+        return
+    colormap = branca.colormap.linear.YlOrRd_09.scale(0, math.log1p(max(counts)))
+    folium.GeoJson(
+        feature_collection,
+        name=f"{table_name} (aggregated)",
+        style_function=lambda feature: {
+            'fillColor': colormap(math.log1p(feature['properties']['count'])),
+            'color': None,
+            'weight': 0,
+            'fillOpacity': 0.6,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['count'], aliases=[f"{table_name} features"]),
+    ).add_to(map_object)
+
+# GeoJSON polygon of the map view returned by st_folium
+def viewport_polygon(bounds):
+    south, west = bounds['_southWest']['lat'], bounds['_southWest']['lng']
+    north, east = bounds['_northEast']['lat'], bounds['_northEast']['lng']
+    return {'type': 'Polygon', 'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
@@ -0,0 +1,158 @@
+import argparse
+import json
+import random
+
+import psycopg2
+import pyproj
+from psycopg2.extras import execute_values
+from shapely.geometry import Point, LineString, MultiLineString, mapping
+from shapely.ops import transform
+
+# Prefix of every generated table, so a run never touches real layers
+TABLE_PREFIX = 'bench_layer_'
+
+# Source SRIDs found in production: WGS84, Web Mercator, CA State Plane V (ft), UTM 11N
+SRIDS = [4326, 3857, 2229, 26911]
+
+# Area the synthetic features are scattered over (Los Angeles, like the default map view)
+BOUNDS = (-118.70, 33.70, -117.80, 34.35)
+
+GEOMETRY_TYPES = ['Point', 'LineString', 'Polygon', 'MultiLineString']
+
+# Build a random geometry of the given type in EPSG:4326
+def random_geometry(rng, geom_type):
+    x = rng.uniform(BOUNDS[0], BOUNDS[2])
+    y = rng.uniform(BOUNDS[1], BOUNDS[3])
+    size = rng.uniform(0.0005, 0.01)
+
+    def random_line(x, y):
+        coords = [(x, y)]
+        for _ in range(rng.randint(2, 20)):
+            x += rng.uniform(-size, size)
+            y += rng.uniform(-size, size)
+            coords.append((x, y))
+        return LineString(coords)
+
+    if geom_type == 'Point':
+        return Point(x, y)
+    elif geom_type == 'LineString':
+        return random_line(x, y)
+    elif geom_type == 'Polygon':
+        return Point(x, y).buffer(size, resolution=rng.randint(2, 8))
+    else:
+        return MultiLineString([random_line(x, y) for _ in range(rng.randint(2, 4))])
+
+# Build an ArcGIS drawing_info renderer like the ones exported from our layers
+def random_drawing_info(rng):
+    color = [rng.randint(0, 255) for _ in range(3)] + [255]
+    outline = [rng.randint(0, 255) for _ in range(3)] + [255]
+    return json.dumps({
+        'renderer': {
+            'type': 'simple',
+            'symbol': {'color': color, 'outline': {'color': outline, 'width': 1}},
+        }
+    })
+
+# Create one synthetic SHAPE table with its metadata row
+def create_table(conn, table_name, rows, srid, rng):
+    geom_type = rng.choice(GEOMETRY_TYPES + ['Mixed'])
+    drawing_info = random_drawing_info(rng)
+    transformer = pyproj.Transformer.from_crs("EPSG:4326", f"EPSG:{srid}", always_xy=True)
+
+    records = []
+    for idx in range(rows):
+        row_type = rng.choice(GEOMETRY_TYPES) if geom_type == 'Mixed' else geom_type
+        geometry = transform(transformer.transform, random_geometry(rng, row_type))
+        records.append((
+            json.dumps(mapping(geometry)),
+            srid,
+            drawing_info,
+            f"Feature {idx}",
+            rng.choice(['Active', 'Abandoned', 'Proposed', '']),
+            rng.randint(1950, 2024),
+        ))
+
+    with conn.cursor() as cursor:
+        cursor.execute(f'DROP TABLE IF EXISTS public.{table_name};')
+        cursor.execute(f"""
+            CREATE TABLE public.{table_name} (
+                objectid serial PRIMARY KEY,
+                "SHAPE" text,
+                srid integer,
+                drawing_info text,
+                name text,
+                status text,
+                install_year integer
+            );
+        """)
+        execute_values(
+            cursor,
+            f'INSERT INTO public.{table_name} ("SHAPE", srid, drawing_info, name, status, install_year) VALUES %s',
+            records,
+            page_size=1000,
+        )
+        cursor.execute('DELETE FROM metadata WHERE layer_name = %s;', (table_name,))
+        cursor.execute(
+            'INSERT INTO metadata (layer_name, srid, drawing_info) VALUES (%s, %s, %s);',
+            (table_name, srid, drawing_info),
+        )
+        cursor.execute(f'ANALYZE public.{table_name};')
+
+# Drop every previously generated table
+def drop_dataset(conn):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT table_name FROM information_schema.tables WHERE table_schema = 'public' AND table_name LIKE %s;",
+            (TABLE_PREFIX + '%',),
+        )
+        for (table_name,) in cursor.fetchall():
+            cursor.execute(f'DROP TABLE public.{table_name};')
+        cursor.execute("DELETE FROM metadata WHERE layer_name LIKE %s;", (TABLE_PREFIX + '%',))
+    conn.commit()
+
+# Generate N synthetic SHAPE tables plus the matching metadata table
+def generate_dataset(conn, tables, rows_per_table, seed=0):
+    rng = random.Random(seed)
+    with conn.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS postgis;')
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS metadata (
+                layer_name text PRIMARY KEY,
+                srid integer,
+                drawing_info text
+            );
+        """)
+    conn.commit()
+    drop_dataset(conn)
+
+    table_names = []
+    for idx in range(tables):
+        table_name = f"{TABLE_PREFIX}{idx:03d}"
+        # Vary table sizes around the requested average, like real layers do
+        rows = max(1, int(rows_per_table * rng.uniform(0.2, 1.8)))
+        create_table(conn, table_name, rows, rng.choice(SRIDS), rng)
+        conn.commit()
+        table_names.append(table_name)
+    return table_names
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic SHAPE tables in a local PostGIS database.')
+    parser.add_argument('--dsn', default='', help='libpq connection string, defaults to the PG* environment variables')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=1000, help='average rows per table')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--drop', action='store_true', help='only drop the generated tables')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        if args.drop:
+            drop_dataset(conn)
+        else:
+            table_names = generate_dataset(conn, args.tables, args.rows, args.seed)
+            print(f"Generated {len(table_names)} tables")
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
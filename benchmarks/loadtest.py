@@ -0,0 +1,225 @@
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psycopg2
+
+import core
+import pooling
+from generate_dataset import TABLE_PREFIX, generate_dataset
+from run_benchmarks import QUERY_POLYGONS, git_revision, stage_render
+
+# Seconds between two samples of database connections and process memory
+SAMPLE_INTERVAL = 0.5
+
+# Route of an HTTP front end answering polygon queries, when one is deployed
+API_ROUTE = '/api/query_polygon'
+
+# A query polygon shifted by a random offset, so concurrent users do not all ask the same thing
+def jittered_polygon(rng, name):
+    dx, dy = rng.uniform(-0.05, 0.05), rng.uniform(-0.05, 0.05)
+    return json.dumps({'type': 'Polygon', 'coordinates': [[(x + dx, y + dy) for x, y in QUERY_POLYGONS[name]]]})
+
+# One request through the query functions, fanned out over the tables like run_table_queries.
+# Without a polygon every geometry is queried, like "Plot All Geometries".
+def query_request(tables, table_columns, polygon_geojson, workers, render):
+    if polygon_geojson is not None:
+        tables, _ = core.prune_tables(tables, polygon_geojson, core.SRID_FROM_COLUMN)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = list(executor.map(
+            lambda table: core.query_table_geometries(table, polygon_geojson, core.SRID_FROM_COLUMN), tables
+        ))
+    features = 0
+    records = []
+    for table, df in zip(tables, frames):
+        if not df.empty:
+            df['table_name'] = table
+            features += len(df)
+            if render:
+                records.extend(df.to_dict(orient='records'))
+    if render and records:
+        stage_render(records, table_columns)
+    return features
+
+# One request against the HTTP route: POST the polygon, read the whole response
+def api_request(url, polygon_geojson):
+    request = urllib.request.Request(
+        url.rstrip('/') + API_ROUTE, data=polygon_geojson.encode('utf-8'),
+        headers={'Content-Type': 'application/json'}, method='POST',
+    )
+    with urllib.request.urlopen(request) as response:
+        body = response.read()
+    try:
+        return len(json.loads(body).get('features', []))
+    except (ValueError, AttributeError):
+        return None
+
+# Sample the server's connections to this database and this process's memory until stopped
+def sample_resources(dsn, stop, samples):
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    try:
+        while not stop.is_set():
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT count(*) FILTER (WHERE state = 'active'), count(*)
+                    FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid();
+                """)
+                active, total = cursor.fetchone()
+            with open('/proc/self/statm') as f:
+                rss = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+            samples.append({'active_connections': active, 'connections': total, 'rss_bytes': rss})
+            stop.wait(SAMPLE_INTERVAL)
+    finally:
+        conn.close()
+
+def percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    def at(share):
+        return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+    return {'p50': at(0.50), 'p95': at(0.95), 'p99': at(0.99), 'mean': statistics.mean(ordered), 'max': ordered[-1]}
+
+# Run simulated users for a duration; each picks a scenario, runs it, and starts over
+def run_load(args, tables, table_columns):
+    deadline = time.monotonic() + args.duration
+    results, lock = [], threading.Lock()
+    polygons = args.polygons.split(',')
+
+    def user(index):
+        rng = random.Random(args.seed + index)
+        while time.monotonic() < deadline:
+            plot_all = rng.random() < args.plot_all_ratio
+            scenario = 'plot_all' if plot_all else rng.choice(polygons)
+            polygon_geojson = None if plot_all else jittered_polygon(rng, scenario)
+            start = time.perf_counter()
+            error = None
+            try:
+                if args.url:
+                    features = api_request(args.url, polygon_geojson or 'null')
+                else:
+                    features = query_request(tables, table_columns, polygon_geojson, args.workers, args.render)
+            except Exception as e:
+                features, error = None, f'{type(e).__name__}: {e}'
+            with lock:
+                results.append({
+                    'scenario': scenario, 'seconds': time.perf_counter() - start,
+                    'features': features, 'error': error,
+                })
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(user, range(args.concurrency)))
+    return results, time.perf_counter() - started
+
+def summarize(results, elapsed, samples):
+    ok = [result for result in results if result['error'] is None]
+    scenarios = {}
+    for name in sorted({result['scenario'] for result in results}):
+        runs = [result for result in results if result['scenario'] == name]
+        scenarios[name] = {
+            'requests': len(runs),
+            'errors': sum(1 for result in runs if result['error'] is not None),
+            'latency': percentiles([result['seconds'] for result in runs if result['error'] is None]),
+        }
+    return {
+        'requests': len(results),
+        'errors': len(results) - len(ok),
+        'error_samples': sorted({result['error'] for result in results if result['error']})[:10],
+        'seconds': elapsed,
+        'throughput_rps': len(ok) / elapsed if elapsed else 0.0,
+        'latency': percentiles([result['seconds'] for result in ok]),
+        'scenarios': scenarios,
+        'connections': {
+            'max': max((sample['connections'] for sample in samples), default=None),
+            'max_active': max((sample['active_connections'] for sample in samples), default=None),
+        },
+        'memory': {
+            'max_rss_bytes': max((sample['rss_bytes'] for sample in samples), default=None),
+            # ru_maxrss is in kilobytes on Linux
+            'peak_rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        },
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay concurrent polygon and Plot All requests against the query path.')
+    parser.add_argument('--dsn', default='', help='libpq connection string, defaults to the PG* environment variables')
+    parser.add_argument('--concurrency', default='1,5,10,20', help='comma separated numbers of simultaneous users')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds per concurrency level')
+    parser.add_argument('--polygons', default=','.join(QUERY_POLYGONS), help='comma separated query polygon names')
+    parser.add_argument('--plot-all-ratio', type=float, default=0.1, help='share of requests that query every geometry')
+    parser.add_argument('--workers', type=int, default=core.DEFAULT_QUERY_WORKERS, help='per-table query threads per request')
+    parser.add_argument('--pool-size', type=int, default=pooling.DEFAULT_POOL_SIZE)
+    parser.add_argument('--render', action='store_true', help='also build the folium map and its HTML for each request')
+    parser.add_argument('--url', help=f'base URL of an app serving {API_ROUTE} (POST a GeoJSON polygon, or null for everything) instead of calling the query functions')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=1000, help='average rows per generated table')
+    parser.add_argument('--skip-generate', action='store_true', help='reuse the dataset already in the database')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_results.json')
+    args = parser.parse_args()
+
+    core.CONNECTION_DSN = args.dsn
+    pooling.get_pool(core.connection_kwargs(), args.pool_size)
+    if not args.skip_generate:
+        conn = psycopg2.connect(args.dsn)
+        try:
+            print(f"Generating {args.tables} tables with ~{args.rows} rows each")
+            generate_dataset(conn, args.tables, args.rows, args.seed)
+        finally:
+            conn.close()
+
+    tables = [table for table in core.get_tables_with_shape_column() if table.startswith(TABLE_PREFIX)]
+    table_columns = {table: core.get_table_columns(table) for table in tables}
+
+    levels = []
+    for concurrency in [int(level) for level in args.concurrency.split(',')]:
+        args.concurrency = concurrency
+        samples, stop = [], threading.Event()
+        sampler = threading.Thread(target=sample_resources, args=(args.dsn, stop, samples), daemon=True)
+        sampler.start()
+        try:
+            results, elapsed = run_load(args, tables, table_columns)
+        finally:
+            stop.set()
+            sampler.join()
+        summary = summarize(results, elapsed, samples)
+        levels.append(dict(summary, concurrency=concurrency))
+        latency = summary['latency'] or {}
+        print(
+            f"  {concurrency} users: {summary['throughput_rps']:.2f} req/s, "
+            f"p50 {latency.get('p50', 0):.3f}s p95 {latency.get('p95', 0):.3f}s p99 {latency.get('p99', 0):.3f}s, "
+            f"{summary['errors']} errors, {summary['connections']['max']} connections"
+        )
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'target': args.url or 'query functions',
+        'tables': len(tables),
+        'rows_per_table': args.rows,
+        'duration': args.duration,
+        'plot_all_ratio': args.plot_all_ratio,
+        'workers': args.workers,
+        'pool_size': args.pool_size,
+        'render': args.render,
+        'levels': levels,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
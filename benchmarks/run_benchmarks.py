@@ -0,0 +1,162 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import psycopg2
+
+import core
+import instrumentation
+from generate_dataset import TABLE_PREFIX, generate_dataset
+
+# Query polygons of increasing size, centered on downtown Los Angeles
+QUERY_POLYGONS = {
+    'small': [(-118.26, 34.04), (-118.23, 34.04), (-118.23, 34.07), (-118.26, 34.07), (-118.26, 34.04)],
+    'medium': [(-118.35, 33.97), (-118.15, 33.97), (-118.15, 34.13), (-118.35, 34.13), (-118.35, 33.97)],
+    'large': [(-118.60, 33.75), (-117.90, 33.75), (-117.90, 34.30), (-118.60, 34.30), (-118.60, 33.75)],
+}
+
+# Imports measured in a fresh interpreter: what an app page loads at startup,
+# against importing every heavy dependency eagerly
+STARTUP_IMPORTS = {
+    'app_startup': 'import core, streamlit_folium',
+    'eager_heavy_imports': 'import arcgis.gis, arcgis.mapping, pyproj, shapely.geometry, folium, pandas, streamlit',
+}
+
+# Schema discovery: tables with a SHAPE column and their columns
+def stage_schema_discovery():
+    tables = [table for table in core.get_tables_with_shape_column() if table.startswith(TABLE_PREFIX)]
+    table_columns = {table: core.get_table_columns(table) for table in tables}
+    return tables, table_columns
+
+# Build the folium layers and render the map HTML, as st_folium does
+def stage_render(metadata_list, table_columns):
+    m = core.initialize_map()
+    geojson_list = [metadata['geometry'] for metadata in metadata_list]
+    spans = instrumentation.start_request()
+    start = time.perf_counter()
+    core.add_geometries_to_map(geojson_list, metadata_list, m, table_columns)
+    add_seconds = time.perf_counter() - start
+
+    stages = {}
+    for span in spans:
+        stages[span['stage']] = stages.get(span['stage'], 0.0) + span['seconds']
+
+    start = time.perf_counter()
+    html = m.get_root().render()
+    return stages, add_seconds, time.perf_counter() - start, len(html)
+
+# Time a callable, returning its result and the elapsed seconds
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+# Run every stage once for one query polygon
+def run_once(polygon):
+    timings = {}
+    (tables, table_columns), timings['schema_discovery'] = timed(stage_schema_discovery)
+
+    polygon_geojson = json.dumps({'type': 'Polygon', 'coordinates': [polygon]})
+    frames, table_timings = [], {}
+    for table in tables:
+        df, table_timings[table] = timed(core.query_geometries_within_polygon_for_table, table, polygon_geojson)
+        if not df.empty:
+            df['table_name'] = table
+            frames.append(df)
+    timings['polygon_query'] = sum(table_timings.values())
+    timings['polygon_query_slowest_table'] = max(table_timings.values(), default=0.0)
+
+    metadata_list = core.pd.concat(frames, ignore_index=True).to_dict(orient='records') if frames else []
+    stages, timings['add_geometries_to_map'], timings['folium_html'], html_bytes = stage_render(metadata_list, table_columns)
+    for stage in ('decode_reproject', 'popup', 'folium_layers'):
+        timings[stage] = stages.get(stage, 0.0)
+
+    timings['total'] = sum(timings[stage] for stage in ('schema_discovery', 'polygon_query', 'add_geometries_to_map', 'folium_html'))
+    return timings, {'tables': len(tables), 'features': len(metadata_list), 'html_bytes': html_bytes}
+
+# Time imports in a fresh interpreter, as on a freshly started pod
+def measure_startup(repeat):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {}
+    for name, statement in STARTUP_IMPORTS.items():
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            completed = subprocess.run([sys.executable, '-c', statement], cwd=root, capture_output=True)
+            if completed.returncode != 0:
+                runs = None
+                break
+            runs.append({'seconds': time.perf_counter() - start})
+        results[name] = summarize(runs) if runs else None
+    return results
+
+# Summarize repeated timings per stage
+def summarize(runs):
+    summary = {}
+    for stage in runs[0]:
+        values = [run[stage] for run in runs]
+        summary[stage] = {'min': min(values), 'median': statistics.median(values), 'max': max(values)}
+    return summary
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the query and render path on a synthetic dataset.')
+    parser.add_argument('--dsn', default='', help='libpq connection string, defaults to the PG* environment variables')
+    parser.add_argument('--tables', type=int, default=20)
+    parser.add_argument('--sizes', default='100,1000,10000', help='comma separated average rows per table')
+    parser.add_argument('--polygons', default=','.join(QUERY_POLYGONS), help='comma separated query polygon names')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args()
+
+    core.CONNECTION_DSN = args.dsn
+    startup = measure_startup(args.repeat)
+    print(f"Startup: {json.dumps({name: summary and summary['seconds']['median'] for name, summary in startup.items()})}")
+
+    conn = psycopg2.connect(args.dsn)
+    results = []
+    try:
+        for rows in [int(size) for size in args.sizes.split(',')]:
+            print(f"Generating {args.tables} tables with ~{rows} rows each")
+            generate_dataset(conn, args.tables, rows, args.seed)
+            for name in args.polygons.split(','):
+                runs, counts = [], None
+                for _ in range(args.repeat):
+                    timings, counts = run_once(QUERY_POLYGONS[name])
+                    runs.append(timings)
+                summary = summarize(runs)
+                results.append({'rows_per_table': rows, 'polygon': name, 'counts': counts, 'timings': summary})
+                print(f"  {name}: {counts['features']} features, total median {summary['total']['median']:.3f}s")
+    finally:
+        conn.close()
+
+    report = {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'tables': args.tables,
+        'repeat': args.repeat,
+        'startup': startup,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Wrote {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import psycopg2.errors
+
+# Server-side limit for a single per-table query, in seconds
+DEFAULT_STATEMENT_TIMEOUT = 30.0
+
+# Overall limit for all per-table queries of one request, in seconds
+DEFAULT_TIME_BUDGET = 60.0
+
+# Raised when a per-table query hit its statement timeout or the request ran out of time budget
+class QueryTimedOut(Exception):
+    pass
+
+# Raised when a newer request of the same session cancelled this one
+class QuerySuperseded(Exception):
+    pass
+
+# One fan-out of per-table queries: its deadline, the connections it has in flight and the
+# features its tables may still send to the browser (no limit when None)
+class QueryRequest:
+    def __init__(self, session_id, time_budget=DEFAULT_TIME_BUDGET, statement_timeout=DEFAULT_STATEMENT_TIMEOUT,
+                 feature_budget=None):
+        self.session_id = session_id
+        self.deadline = time.monotonic() + time_budget
+        self.statement_timeout = statement_timeout
+        self.features_left = feature_budget
+        self.cancelled = False
+        self.connections = set()
+        self.lock = threading.Lock()
+
+    # Time left before the deadline, in seconds
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    # Statement timeout for the next table: the per-table limit, capped by the remaining budget
+    def table_timeout(self):
+        return min(self.statement_timeout, self.remaining())
+
+    # Reserve room for a table's estimated features; False when they do not fit in what is left
+    def reserve_features(self, count):
+        with self.lock:
+            if self.features_left is None:
+                return True
+            if count > self.features_left:
+                return False
+            self.features_left -= count
+            return True
+
+    # Track a connection so cancel() can interrupt its query
+    def register(self, conn):
+        with self.lock:
+            if self.cancelled:
+                raise QuerySuperseded()
+            self.connections.add(conn)
+
+    def unregister(self, conn):
+        with self.lock:
+            self.connections.discard(conn)
+
+    # Cancel every query still running on the server. This holds the lock so that a pooled
+    # connection, once unregistered and handed to another request, is never cancelled.
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for conn in self.connections:
+                try:
+                    conn.cancel()
+                except Exception:
+                    pass
+
+_active_requests = {}
+_lock = threading.Lock()
+
+# Start a request for a session, cancelling the request it supersedes
+def begin_query_request(session_id, time_budget=DEFAULT_TIME_BUDGET, statement_timeout=DEFAULT_STATEMENT_TIMEOUT,
+                        feature_budget=None):
+    request = QueryRequest(session_id, time_budget, statement_timeout, feature_budget)
+    with _lock:
+        previous = _active_requests.get(session_id)
+        _active_requests[session_id] = request
+    if previous is not None:
+        previous.cancel()
+    return request
+
+def end_query_request(request):
+    with _lock:
+        if _active_requests.get(request.session_id) is request:
+            del _active_requests[request.session_id]
+
+# Set the server-side statement timeout of a connection
+def set_statement_timeout(conn, seconds):
+    with conn.cursor() as cursor:
+        cursor.execute('SET statement_timeout = %s;', (max(1, int(seconds * 1000)),))
+
+# True for errors caused by statement_timeout or a cancel request (SQLSTATE 57014),
+# including the DatabaseError pandas wraps them in
+def is_query_canceled(error):
+    while error is not None:
+        if isinstance(error, psycopg2.errors.QueryCanceled):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+# Translate a cancelled query into QueryTimedOut or QuerySuperseded
+def raise_for_canceled(request, error, table_name):
+    if request.cancelled:
+        raise QuerySuperseded(table_name) from error
+    raise QueryTimedOut(table_name) from error
@@ -0,0 +1,1581 @@
+import importlib.util
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import psycopg2
+import streamlit as st
+from psycopg2 import sql
+
+import aggregation
+import cancellation
+import diagnostics
+import instrumentation
+import table_changes
+
+# Import a module on first attribute access, so pages that never query or
+# render results do not pay for pandas, pyproj or folium at startup
+def lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+pd = lazy_import('pandas')
+pyproj = lazy_import('pyproj')
+folium = lazy_import('folium')
+
+# Connection string used instead of st.secrets, e.g. by the benchmarks
+CONNECTION_DSN = None
+
+# Where a table's SRID and drawing_info come from: columns of the table itself,
+# or the metadata table matched by layer name
+SRID_FROM_COLUMN = 'column'
+SRID_FROM_METADATA = 'metadata'
+
+# Geometry of a row in EPSG:4326, as intersected by the polygon query;
+# srid is the table's srid column or a literal SRID from the metadata table
+def shape_4326(srid='srid'):
+    return f'ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON("SHAPE"::json), {srid}), 4326)'
+
+# Worker threads running the per-table queries of one request; with more than one,
+# progressive rendering shows the fastest table first
+DEFAULT_QUERY_WORKERS = 4
+
+# Outcome of each table in the last fan-out
+TABLE_PENDING = 'pending'
+TABLE_OK = 'ok'
+TABLE_TIMED_OUT = 'timed out'
+TABLE_CANCELLED = 'cancelled'
+TABLE_AGGREGATED = 'aggregated'
+TABLE_SKIPPED = 'skipped (outside extent)'
+
+# How geometries travel from PostgreSQL: GeoJSON text reprojected in Python,
+# or binary WKB reprojected on the server and decoded in bulk
+TRANSFER_JSON = 'json'
+TRANSFER_WKB = 'wkb'
+
+# Read a setting from st.secrets, falling back to the default when it or the secrets file is missing
+def secret_setting(name, default=None):
+    try:
+        return st.secrets.get(name, default)
+    except Exception:
+        return default
+
+# Read a per-session setting, falling back to the default outside a Streamlit session
+def session_setting(name, default=None):
+    try:
+        return st.session_state.get(name, default)
+    except Exception:
+        return default
+
+# Local snapshot directory written by snapshot.py: secrets snapshot_path. When set, tables,
+# metadata and queries are read from the snapshot instead of the database.
+def snapshot_path():
+    return secret_setting("snapshot_path")
+
+# Initialize session state for geometries if not already done
+def init_session_state():
+    defaults = {
+        'geojson_list': [],
+        'metadata_list': [],
+        'map_initialized': False,
+        'table_columns': {},
+        'table_to_layer': {},
+        'spans': [],
+    }
+    for key, value in defaults.items():
+        if key not in st.session_state:
+            st.session_state[key] = value
+
+# Connection parameters from CONNECTION_DSN or st.secrets
+def connection_kwargs():
+    if CONNECTION_DSN is not None:
+        return {'dsn': CONNECTION_DSN}
+    return {
+        'host': st.secrets["db_host"],
+        'database': st.secrets["db_name"],
+        'user': st.secrets["db_user"],
+        'password': st.secrets["db_password"],
+        'port': st.secrets["db_port"],
+    }
+
+# Database connection function
+def get_connection():
+    try:
+        return psycopg2.connect(**connection_kwargs())
+    except Exception as e:
+        st.error(f"Connection error: {e}")
+        return None
+
+# Borrow a connection from the process-wide pool (pool_size in secrets); per-table queries
+# run on these so their prepared statements are reused. None when connecting failed.
+def get_pooled_connection():
+    import pooling
+
+    try:
+        pool = pooling.get_pool(
+            connection_kwargs(),
+            int(secret_setting("pool_size", pooling.DEFAULT_POOL_SIZE)),
+            float(secret_setting("pool_timeout", pooling.DEFAULT_POOL_TIMEOUT)),
+        )
+        return pool.getconn()
+    except Exception as e:
+        st.error(f"Connection error: {e}")
+        return None
+
+# Give a pooled connection back, its transaction rolled back
+def release_connection(conn):
+    import pooling
+
+    pooling.get_pool(connection_kwargs()).putconn(conn)
+
+# Query all tables with a "SHAPE" column
+def get_tables_with_shape_column():
+    if snapshot_path():
+        import snapshot
+        return snapshot.snapshot_tables(snapshot_path())
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        query = """
+        SELECT table_name
+        FROM information_schema.columns
+        WHERE column_name = 'SHAPE' AND table_schema = 'public';
+        """
+        with instrumentation.span('schema_discovery') as span:
+            df = pd.read_sql(query, conn)
+            span['rows'] = len(df)
+        conn.close()
+        return df['table_name'].tolist()
+    except Exception as e:
+        st.error(f"Error fetching table names: {e}")
+        return []
+
+# Get column names for a specific table
+def get_table_columns(table_name):
+    if snapshot_path():
+        import snapshot
+        return snapshot.snapshot_columns(snapshot_path(), table_name)
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        query = """
+        SELECT column_name
+        FROM information_schema.columns
+        WHERE table_name = %s AND table_schema = 'public';
+        """
+        with instrumentation.span('table_columns', table_name):
+            df = pd.read_sql(query, conn, params=(table_name,))
+        conn.close()
+        return df['column_name'].tolist()
+    except Exception as e:
+        st.error(f"Error fetching columns for table {table_name}: {e}")
+        return []
+
+# Get all layer names from the metadata table
+def get_layer_names_from_metadata():
+    if snapshot_path():
+        import snapshot
+        return snapshot.snapshot_metadata(snapshot_path())['layer_name'].tolist()
+    conn = get_connection()
+    if conn is None:
+        return []
+    try:
+        query = "SELECT layer_name FROM metadata;"
+        df = pd.read_sql(query, conn)
+        conn.close()
+        return df['layer_name'].tolist()
+    except Exception as e:
+        st.error(f"Error fetching layer names from metadata: {e}")
+        return []
+
+# Create a dictionary to map table names to layer names
+def create_table_to_layer_mapping(table_names, layer_names):
+    mapping = {}
+    unmatched_tables = set(table_names)
+
+    for table_name in table_names:
+        # Remove special characters, replace spaces with underscores, and convert to lowercase for matching
+        sanitized_table_name = re.sub(r'\W+', '', table_name.replace('_', ' ')).lower()
+        for layer_name in layer_names:
+            sanitized_layer_name = re.sub(r'\W+', '', layer_name.replace(' ', '_')).lower()
+            if sanitized_table_name == sanitized_layer_name:
+                mapping[table_name] = layer_name
+                unmatched_tables.discard(table_name)
+                break
+
+    # For unmatched tables, attempt a more flexible match
+    for table_name in unmatched_tables:
+        best_match = None
+        best_match_score = 0
+        sanitized_table_name = re.sub(r'\W+', '', table_name.replace('_', ' ')).lower()
+        for layer_name in layer_names:
+            sanitized_layer_name = re.sub(r'\W+', '', layer_name.replace(' ', '_')).lower()
+            match_score = sum(1 for a, b in zip(sanitized_table_name, sanitized_layer_name) if a == b)
+            if match_score > best_match_score:
+                best_match = layer_name
+                best_match_score = match_score
+        if best_match:
+            mapping[table_name] = best_match
+
+    return mapping
+
+# Map tables to metadata layers once per session
+def ensure_table_to_layer_mapping(tables):
+    if not st.session_state.table_to_layer:
+        st.session_state.table_to_layer = create_table_to_layer_mapping(tables, get_layer_names_from_metadata())
+    return st.session_state.table_to_layer
+
+# A metadata srid as read into a frame: NULL comes back as NaN once other rows have one
+def metadata_srid(value):
+    return None if pd.isna(value) else value
+
+# Get metadata for a specific table using the mapping dictionary
+def get_metadata_for_table(table_name):
+    layer_name = st.session_state.table_to_layer.get(table_name)
+    if not layer_name:
+        return None, None
+    if snapshot_path():
+        import snapshot
+        df = snapshot.snapshot_metadata(snapshot_path())
+        df = df[df['layer_name'] == layer_name]
+        if df.empty:
+            return None, None
+        return metadata_srid(df['srid'].iloc[0]), df['drawing_info'].iloc[0]
+    conn = get_connection()
+    if conn is None:
+        return None, None
+    try:
+        query = """
+        SELECT srid, drawing_info
+        FROM metadata
+        WHERE layer_name = %s;
+        """
+        df = pd.read_sql(query, conn, params=(layer_name,))
+        conn.close()
+        if df.empty:
+            return None, None
+        return metadata_srid(df['srid'].iloc[0]), df['drawing_info'].iloc[0]
+    except Exception as e:
+        st.error(f"Error fetching metadata for table {table_name}: {e}")
+        return None, None
+
+# Columns selected next to the geometry as GeoJSON text; without an srid the table's own srid and drawing_info are used
+def geometry_columns(srid=None):
+    if srid is None:
+        return sql.SQL('"SHAPE"::text as geometry, srid, drawing_info::text as drawing_info')
+    return sql.SQL('"SHAPE"::text as geometry')
+
+# Placeholder of a bound parameter: named for psycopg2, or positional ($1, $2) inside a
+# prepared statement
+def bind(name, prepared=False):
+    if prepared:
+        import pooling
+        return sql.SQL(f'${pooling.parameter_index(name)}')
+    return sql.Placeholder(name)
+
+# Values of the bound parameters of a per-table query
+def query_params(polygon_geojson=None, srid=None):
+    return {'polygon': polygon_geojson, 'srid': None if srid is None else int(srid)}
+
+# shape_4326 as composable SQL, with a metadata SRID bound as a parameter
+def shape_4326_sql(srid=None, prepared=False):
+    return sql.SQL('ST_Transform(ST_SetSRID(ST_GeomFromGeoJSON({shape}::json), {srid}), 4326)').format(
+        shape=sql.Identifier('SHAPE'),
+        srid=sql.Identifier('srid') if srid is None else bind('srid', prepared),
+    )
+
+# How geometries are transferred: secrets geometry_transfer, WKB unless set to 'json'
+def geometry_transfer():
+    return secret_setting("geometry_transfer", TRANSFER_WKB)
+
+# Columns of a table, looked up once per session
+def cached_table_columns(table_name):
+    table_columns = session_setting('table_columns', {})
+    if table_name not in table_columns:
+        table_columns[table_name] = get_table_columns(table_name)
+    return table_columns[table_name]
+
+# Columns shown in each table's popups: its own columns plus the ones added to its results
+# (matched_areas), which must never reach a SELECT list
+def popup_columns():
+    extra = session_setting('extra_popup_columns', {})
+    return {
+        table: list(columns) + [column for column in extra.get(table, []) if column not in columns]
+        for table, columns in session_setting('table_columns', {}).items()
+    }
+
+# The geometry as transferred with WKB: shape_4326_sql, snapped to quantize_digits decimals
+# when set in secrets
+def quantized_geometry(srid=None, prepared=False):
+    geometry = shape_4326_sql(srid, prepared)
+    digits = secret_setting("quantize_digits")
+    if digits is not None:
+        geometry = sql.SQL('ST_RemoveRepeatedPoints(ST_SnapToGrid({}, {}))').format(geometry, sql.Literal(10 ** -int(digits)))
+    return geometry
+
+# Select list for WKB transfer: every column but "SHAPE", and the geometry as WKB already
+# reprojected to EPSG:4326. With quantize_digits in secrets, coordinates are snapped to that
+# many decimals and the vertices this collapses are dropped before transfer.
+def wkb_select_list(table_name, srid=None, prepared=False):
+    geometry = quantized_geometry(srid, prepared)
+
+    skipped = {'SHAPE'} if srid is not None else {'SHAPE', 'drawing_info'}
+    columns = [sql.Identifier(column) for column in cached_table_columns(table_name) if column not in skipped]
+    columns.append(sql.SQL('ST_AsBinary({}) AS geometry_wkb').format(geometry))
+    if srid is None:
+        columns.append(sql.SQL('drawing_info::text as drawing_info'))
+    return sql.SQL(', ').join(columns)
+
+# WHERE clause matching the rows that intersect a polygon, or every row with a geometry.
+# The polygon and a metadata SRID are bound parameters, see query_params.
+def build_where(polygon_geojson=None, srid=None, prepared=False):
+    if polygon_geojson is None:
+        return sql.SQL('{} IS NOT NULL').format(sql.Identifier('SHAPE'))
+    return sql.SQL('ST_Intersects({}, ST_SetSRID(ST_GeomFromGeoJSON({}), 4326))').format(
+        shape_4326_sql(srid, prepared), bind('polygon', prepared)
+    )
+
+# Build the query selecting the geometries of a table that intersect a polygon,
+# or every geometry of the table without one. Short lines and small polygons that quantizing
+# collapses to EMPTY have nothing to draw and are left out on the server.
+def build_table_query(table_name, polygon_geojson=None, srid=None, prepared=False, limit=None):
+    where = build_where(polygon_geojson, srid, prepared)
+    if geometry_transfer() == TRANSFER_WKB:
+        select = wkb_select_list(table_name, srid, prepared)
+        if secret_setting("quantize_digits") is not None:
+            where = sql.SQL('{} AND NOT ST_IsEmpty({})').format(where, quantized_geometry(srid, prepared))
+    else:
+        select = sql.SQL('*, {}').format(geometry_columns(srid))
+    query = sql.SQL('SELECT {} FROM {} WHERE {}').format(select, sql.Identifier('public', table_name), where)
+    if limit is not None:
+        query = sql.SQL('{} LIMIT {}').format(query, sql.Literal(int(limit)))
+    return query
+
+# Decode a WKB geometry column in bulk into shapely geometries, which are in EPSG:4326
+def decode_wkb_geometries(df):
+    import shapely
+
+    if 'geometry_wkb' not in df.columns:
+        return df
+    with instrumentation.span('decode_wkb') as span:
+        df['geometry'] = shapely.from_wkb([bytes(value) if value is not None else None for value in df['geometry_wkb']])
+        df['srid'] = 4326
+        span['rows'] = len(df)
+    return df.drop(columns=['geometry_wkb'])
+
+# Decode the geometries of a result (GeoJSON text or shapely) into a shapely array in EPSG:4326;
+# every row needs an srid
+def geometries_4326(geometries, srids):
+    import numpy as np
+    import shapely
+    from parallel_build import reproject
+
+    geometries = np.array(
+        [shapely.from_geojson(geometry) if isinstance(geometry, str) else geometry for geometry in geometries],
+        dtype=object,
+    )
+    srids = np.asarray(srids, dtype=int)
+    for srid in set(srids.tolist()) - {4326}:
+        mask = srids == srid
+        geometries[mask] = reproject(geometries[mask], srid)
+    return geometries
+
+# Resolve the SRID and drawing_info of a table in metadata mode, (None, None) in column mode;
+# taken from srids, as returned by table_srids, when given
+def table_srid(table_name, srid_source, srids=None):
+    if srids is not None and table_name in srids:
+        return srids[table_name]
+    if srid_source == SRID_FROM_METADATA:
+        return get_metadata_for_table(table_name)
+    return None, None
+
+# table_srid of many tables at once, with a single metadata query, resolved once per request
+def table_srids(tables, srid_source):
+    srids = {table: (None, None) for table in tables}
+    if srid_source != SRID_FROM_METADATA:
+        return srids
+    layers = {table: st.session_state.table_to_layer.get(table) for table in tables}
+    layer_names = sorted({layer_name for layer_name in layers.values() if layer_name})
+    if not layer_names:
+        return srids
+    if snapshot_path():
+        import snapshot
+        df = snapshot.snapshot_metadata(snapshot_path())
+    else:
+        conn = get_connection()
+        if conn is None:
+            return srids
+        try:
+            df = pd.read_sql(
+                'SELECT layer_name, srid, drawing_info FROM metadata WHERE layer_name = ANY(%s);', conn, params=(layer_names,)
+            )
+        except Exception as e:
+            st.error(f"Error fetching metadata: {e}")
+            return srids
+        finally:
+            conn.close()
+    df = df.drop_duplicates('layer_name')
+    metadata = dict(zip(df['layer_name'], zip(map(metadata_srid, df['srid']), df['drawing_info'])))
+    for table, layer_name in layers.items():
+        if layer_name in metadata:
+            srids[table] = metadata[layer_name]
+    return srids
+
+# Run a per-table query, capturing its plan in diagnostics mode when it is slow
+def read_table_query(conn, table_name, query, geometry_expression, params=None):
+    start = time.perf_counter()
+    with instrumentation.span('sql', table_name) as span:
+        df = pd.read_sql(query, conn, params=params)
+        span['rows'] = len(df)
+        span['bytes'] = int(df.memory_usage(deep=True).sum())
+        if 'geometry_wkb' in df.columns:
+            span['bytes'] += int(sum(len(value) for value in df['geometry_wkb'] if value is not None))
+    elapsed = time.perf_counter() - start
+
+    threshold = float(session_setting('slow_query_threshold', diagnostics.DEFAULT_SLOW_QUERY_THRESHOLD))
+    if session_setting('diagnostics_mode', False) and elapsed > threshold:
+        try:
+            if params is not None:
+                with conn.cursor() as cursor:
+                    query = cursor.mogrify(query, params).decode('utf-8')
+            diagnostics.record_slow_query(conn, table_name, query, elapsed, geometry_expression)
+        except Exception as e:
+            st.warning(f"Could not capture the plan of table {table_name}: {e}")
+
+    # Ensure no duplicate columns
+    return df.loc[:, ~df.columns.duplicated()]
+
+# Tables answered from an in-process spatial index: secrets indexed_tables, a list of table
+# names or "*" for every table
+def is_indexed_table(table_name):
+    indexed = secret_setting("indexed_tables")
+    if not indexed:
+        return False
+    return indexed == '*' or table_name in indexed
+
+# Answer a polygon query from the table's in-process index, then fetch the attributes of the
+# matching rows only, by ctid (at most limit of them); None while the index is not loaded yet
+def query_indexed_table(conn, table_name, polygon_geojson, srid, limit=None):
+    import shapely
+    import spatial_index
+
+    geometry_expression = shape_4326(srid or 'srid')
+    with instrumentation.span('index_lookup', table_name) as span:
+        index = spatial_index.get_index(
+            get_connection, table_name, geometry_expression,
+            float(secret_setting("index_refresh_interval", spatial_index.DEFAULT_REFRESH_INTERVAL)),
+        )
+        if index is None:
+            return None
+        ctids, geometries = index.query(shapely.from_geojson(polygon_geojson))
+        if limit is not None:
+            ctids, geometries = ctids[:limit], geometries[:limit]
+        span['rows'] = len(ctids)
+    if not len(ctids):
+        return pd.DataFrame()
+
+    skipped = {'SHAPE'} if srid is not None else {'SHAPE', 'drawing_info'}
+    columns = [sql.Identifier(column) for column in cached_table_columns(table_name) if column not in skipped]
+    if srid is None:
+        columns.append(sql.SQL('drawing_info::text as drawing_info'))
+    columns.append(sql.SQL('ctid::text AS index_ctid'))
+    query = sql.SQL('SELECT {} FROM {} WHERE ctid = ANY(%(ctids)s::tid[]);').format(
+        sql.SQL(', ').join(columns), sql.Identifier('public', table_name)
+    ).as_string(conn)
+    df = read_table_query(conn, table_name, query, geometry_expression, {'ctids': list(ctids)})
+
+    # Rows updated since the last refresh are gone from their old ctid and dropped here
+    geometry_by_ctid = dict(zip(ctids, geometries))
+    df['geometry'] = df['index_ctid'].map(geometry_by_ctid)
+    df['srid'] = 4326
+    return df.drop(columns=['index_ctid'])
+
+# The cross-session result cache, enabled by result_cache_mb in secrets (not used on a snapshot),
+# with its change counters refreshed; None when disabled
+def shared_result_cache():
+    import result_cache
+
+    memory_limit = secret_setting("result_cache_mb")
+    if not memory_limit or snapshot_path():
+        return None
+    disk_limit = secret_setting("result_cache_disk_mb")
+    try:
+        cache = result_cache.get_cache(int(memory_limit), secret_setting("result_cache_dir"), int(disk_limit) if disk_limit else None)
+    except OSError as e:
+        st.warning(f"Not using the result cache: {e}")
+        return None
+    try:
+        cache.refresh_counters(get_connection, float(secret_setting("result_cache_check_interval", table_changes.DEFAULT_CHECK_INTERVAL)))
+    except Exception as e:
+        st.warning(f"Could not check tables for changes, not using the result cache: {e}")
+        return None
+    return cache
+
+# Everything a cached per-table result depends on besides the table's rows
+def result_cache_key(kind, table_name, polygon_geojson, srid, drawing_info):
+    return (
+        table_name, kind, polygon_geojson, None if srid is None else int(srid), repr(drawing_info),
+        geometry_transfer(), secret_setting("quantize_digits"),
+        feature_threshold(),
+    )
+
+# Read a table's matching rows from the local snapshot; its geometries are already in EPSG:4326
+def query_snapshot_table(table_name, polygon_geojson=None, drawing_info=None):
+    import snapshot
+
+    try:
+        with instrumentation.span('snapshot', table_name) as span:
+            df = snapshot.snapshot_query(snapshot_path(), table_name, polygon_geojson)
+            span['rows'] = len(df)
+    except Exception as e:
+        st.error(f"Snapshot error in table {table_name}: {e}")
+        return pd.DataFrame()
+    if drawing_info is not None:
+        df['drawing_info'] = drawing_info
+    return df
+
+# Run one per-table query on its own connection, under the request's statement timeout, or
+# serve it from the shared result cache when enabled. Without a polygon every geometry of the
+# table is selected; with a limit, at most that many rows are fetched.
+def query_table_geometries(table_name, polygon_geojson=None, srid_source=SRID_FROM_COLUMN, request=None, srids=None,
+                           limit=None):
+    srid, drawing_info = table_srid(table_name, srid_source, srids)
+    if srid_source == SRID_FROM_METADATA and srid is None:
+        st.error(f"SRID not found for table {table_name}.")
+        return pd.DataFrame()
+    if request is not None and request.table_timeout() <= 0:
+        raise cancellation.QueryTimedOut(table_name)
+    if snapshot_path():
+        return query_snapshot_table(table_name, polygon_geojson, drawing_info)
+
+    cache = shared_result_cache()
+    if cache is not None:
+        key = result_cache_key('features', table_name, polygon_geojson, srid, drawing_info) + (limit,)
+        counter = cache.counter(table_name)
+        cached = cache.get(key)
+        if cached is not None:
+            instrumentation.record('result_cache_hit', 0.0, table_name, len(cached))
+            # Callers add columns, the cached frame stays as stored
+            return cached.copy(deep=False)
+
+    df = query_table_geometries_uncached(table_name, polygon_geojson, srid, drawing_info, request, limit)
+    if cache is not None and df is not None:
+        import result_cache
+        cache.put(key, df.copy(deep=False), result_cache.result_size(df), counter)
+    return pd.DataFrame() if df is None else df
+
+# Query one table on its own connection; returns None when the query failed
+def query_table_geometries_uncached(table_name, polygon_geojson, srid, drawing_info, request, limit=None):
+    with instrumentation.span('connect', table_name):
+        conn = get_pooled_connection()
+    if conn is None:
+        return None
+    try:
+        if request is not None:
+            request.register(conn)
+            cancellation.set_statement_timeout(conn, request.table_timeout())
+
+        if polygon_geojson is not None and is_indexed_table(table_name):
+            try:
+                df = query_indexed_table(conn, table_name, polygon_geojson, srid, limit)
+            except Exception as e:
+                if request is not None and cancellation.is_query_canceled(e):
+                    raise
+                # Fall back to the SQL query, in a fresh transaction under the same timeout
+                instrumentation.logger.warning(f"Index lookup failed for table {table_name}, querying it in SQL: {e}")
+                conn.rollback()
+                if request is not None:
+                    cancellation.set_statement_timeout(conn, request.table_timeout())
+                df = None
+            if df is not None:
+                if srid is not None:
+                    df['drawing_info'] = drawing_info
+                return df
+
+        # Prepared once per pooled connection, later queries of the table skip parse and plan
+        import pooling
+        query = pooling.prepare(conn, build_table_query(table_name, polygon_geojson, srid, prepared=True, limit=limit))
+        df = read_table_query(conn, table_name, query, shape_4326(srid or 'srid'), query_params(polygon_geojson, srid))
+
+        if srid is not None:
+            df['srid'] = srid
+            df['drawing_info'] = drawing_info
+        return decode_wkb_geometries(df)
+    except (cancellation.QueryTimedOut, cancellation.QuerySuperseded):
+        raise
+    except Exception as e:
+        if request is not None and cancellation.is_query_canceled(e):
+            cancellation.raise_for_canceled(request, e, table_name)
+        st.error(f"Query error in table {table_name}: {e}")
+        return None
+    finally:
+        if request is not None:
+            request.unregister(conn)
+        release_connection(conn)
+
+# Query geometries within a polygon for a specific table
+def query_geometries_within_polygon_for_table(table_name, polygon_geojson, srid_source=SRID_FROM_COLUMN, request=None):
+    return query_table_geometries(table_name, polygon_geojson, srid_source, request)
+
+# Estimate a table's hits before fetching them; above the feature threshold, or when they do
+# not fit in what is left of the request's total, count them per grid cell on the server
+# instead and return (estimate, cells as a GeoJSON FeatureCollection).
+# Returns None when the raw features should be fetched. With force, the table is known to be
+# above the threshold and is counted without estimating it.
+def aggregate_table(table_name, polygon_geojson=None, srid_source=SRID_FROM_COLUMN, request=None, srids=None,
+                    force=False):
+    threshold = feature_threshold()
+    if threshold <= 0:
+        return None
+    srid, _ = table_srid(table_name, srid_source, srids)
+    if srid_source == SRID_FROM_METADATA and srid is None:
+        return None
+    if snapshot_path():
+        return aggregate_snapshot_table(table_name, polygon_geojson, threshold)
+
+    # Grid counts of tables above the threshold are cached; a table small enough to fetch is
+    # estimated again, which is cheap. Its lookup always misses, so only lookups of tables that
+    # turn out to be aggregated count as misses.
+    cache = shared_result_cache()
+    if cache is not None:
+        key = result_cache_key('aggregate', table_name, polygon_geojson, srid, None)
+        counter = cache.counter(table_name)
+        cached = cache.get(key, count_miss=False)
+        if cached is not None:
+            instrumentation.record('result_cache_hit', 0.0, table_name, cached[0])
+            return cached
+
+    aggregate = aggregate_table_uncached(table_name, polygon_geojson, srid, threshold, request, force)
+    if cache is not None and aggregate is not None and aggregate[0] > threshold:
+        cache.miss()
+        cache.put(key, aggregate, len(json.dumps(aggregate[1])), counter)
+    return aggregate
+
+# The table's EPSG:4326 extent and occupancy grid, or None while unknown; it is then computed
+# in the background
+def table_extent(table_name, srid):
+    import extents
+
+    registry = extents.get_registry()
+    registry.refresh_counters(get_connection, float(secret_setting("extent_check_interval", table_changes.DEFAULT_CHECK_INTERVAL)))
+    return registry.get(get_connection, table_name, shape_4326(int(srid) if srid is not None else 'srid'))
+
+# Estimate a table's hits. The planner has no statistics on the polygon test, an expression
+# over GeoJSON text, and would return a fixed share of the table; a polygon's hits are instead
+# the table's row count scaled by the polygon's share of its occupied extent, or counted (up
+# to just above the threshold) while the extent or the row count is unknown.
+def estimate_table_rows(conn, table_name, polygon_geojson, srid, where, method, threshold, params):
+    if method == aggregation.ESTIMATE_PLANNER and polygon_geojson is not None:
+        import shapely
+
+        try:
+            extent = table_extent(table_name, srid)
+        except Exception as e:
+            instrumentation.logger.warning(f"Could not read the extent of table {table_name}: {e}")
+            extent = None
+        rows = aggregation.table_row_count(conn, table_name) if extent is not None else None
+        if rows is None:
+            method = aggregation.ESTIMATE_COUNT
+        else:
+            return int(round(rows * extent.overlap_share(shapely.from_geojson(polygon_geojson))))
+    return aggregation.estimate_rows(conn, table_name, where, method, threshold, params)
+
+# Estimate a table's hits and count them per grid cell when above the threshold or the
+# request's remaining feature budget; with force, count them without estimating
+def aggregate_table_uncached(table_name, polygon_geojson, srid, threshold, request, force=False):
+    conn = get_pooled_connection()
+    if conn is None:
+        return None
+    try:
+        if request is not None:
+            request.register(conn)
+            cancellation.set_statement_timeout(conn, request.table_timeout())
+
+        where = build_where(polygon_geojson, srid)
+        params = query_params(polygon_geojson, srid)
+        estimate = None
+        if not force:
+            method = secret_setting("estimate_method", aggregation.ESTIMATE_PLANNER)
+            with instrumentation.span('estimate', table_name) as span:
+                estimate = estimate_table_rows(conn, table_name, polygon_geojson, srid, where, method, threshold, params)
+                span['rows'] = estimate
+            if estimate <= threshold and (request is None or request.reserve_features(estimate)):
+                return None
+
+        with instrumentation.span('aggregate', table_name) as span:
+            cells = aggregation.fetch_grid_counts(
+                conn, table_name, where, shape_4326_sql(srid), aggregation.cell_size_for(polygon_geojson), params
+            )
+            span['rows'] = len(cells['features'])
+        if estimate is None:
+            estimate = sum(feature['properties']['count'] for feature in cells['features'])
+        return estimate, cells
+    except Exception as e:
+        if request is not None and cancellation.is_query_canceled(e):
+            cancellation.raise_for_canceled(request, e, table_name)
+        st.warning(f"Could not estimate the size of table {table_name}, fetching its features: {e}")
+        return None
+    finally:
+        if request is not None:
+            request.unregister(conn)
+        release_connection(conn)
+
+# Grid counts of a snapshot table, computed in Python from its matching rows
+def aggregate_snapshot_table(table_name, polygon_geojson, threshold):
+    import shapely
+
+    df = query_snapshot_table(table_name, polygon_geojson)
+    if len(df) <= threshold:
+        return None
+    with instrumentation.span('aggregate', table_name) as span:
+        points = shapely.point_on_surface(df['geometry'].values)
+        cells = aggregation.count_points(
+            shapely.get_x(points), shapely.get_y(points), aggregation.cell_size_for(polygon_geojson)
+        )
+        span['rows'] = len(cells['features'])
+    return len(df), cells
+
+# Let a worker thread use the session's Streamlit context and collect spans into its request
+def attach_request_context(ctx, spans):
+    if ctx is not None:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx
+        add_script_run_ctx(threading.current_thread(), ctx)
+    instrumentation.start_request(spans)
+
+# Query one table in a worker thread and remember its columns for the popups.
+# Returns (features, None), or (empty frame, (estimate, cells)) for an aggregated table.
+# Estimates can be far off (on clustered tables, say), so features are fetched up to just
+# above the threshold and the table is aggregated after all when that is reached.
+def fetch_table(table, polygon_geojson, srid_source, request, srids=None):
+    threshold = feature_threshold()
+    with instrumentation.span('table_query', table):
+        aggregate = aggregate_table(table, polygon_geojson, srid_source, request, srids)
+        if aggregate is not None:
+            return pd.DataFrame(), aggregate
+        df = query_table_geometries(
+            table, polygon_geojson, srid_source, request, srids, threshold + 1 if threshold > 0 else None
+        )
+        if threshold > 0 and len(df) > threshold:
+            aggregate = aggregate_table(table, polygon_geojson, srid_source, request, srids, force=True)
+            if aggregate is not None:
+                return pd.DataFrame(), aggregate
+    if not df.empty:
+        df['table_name'] = table
+        st.session_state.table_columns[table] = get_table_columns(table)
+    return df, None
+
+# Tables estimated above this many features are aggregated; 0 turns aggregation off
+def feature_threshold():
+    return int(secret_setting("feature_threshold", aggregation.DEFAULT_FEATURE_THRESHOLD))
+
+# Start the session's query request, with the time budget, statement timeout and total feature
+# threshold from secrets, cancelling the one it supersedes
+def begin_query_request(ctx):
+    return cancellation.begin_query_request(
+        ctx.session_id if ctx is not None else None,
+        float(secret_setting("query_time_budget", cancellation.DEFAULT_TIME_BUDGET)),
+        float(secret_setting("statement_timeout", cancellation.DEFAULT_STATEMENT_TIMEOUT)),
+        int(secret_setting("total_feature_threshold", aggregation.DEFAULT_TOTAL_FEATURE_THRESHOLD)) or None,
+    )
+
+# Run the per-table queries of one request in worker threads, under a statement timeout and
+# an overall time budget. The script thread keeps updating the progress bar, which is where
+# Streamlit interrupts a run superseded by a newer interaction; in-flight queries are then
+# cancelled on the server. Each table's outcome is kept in st.session_state.table_status,
+# grid counts of aggregated tables in st.session_state.aggregates, and
+# on_result(table, df, cells) is called on the script thread as soon as a table returns.
+# srids are the tables' table_srid, resolved once for the request.
+def run_table_queries(tables, polygon_geojson, srid_source, on_result=None, skipped=(), srids=None):
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    request = begin_query_request(ctx)
+    statuses = {table: {'status': TABLE_PENDING, 'rows': None} for table in tables}
+    statuses.update({table: {'status': TABLE_SKIPPED, 'rows': 0} for table in skipped})
+    st.session_state.table_status = statuses
+    st.session_state.aggregates = {}
+    st.session_state.aggregate_polygon = polygon_geojson
+    st.session_state.drilled_view = None
+    all_data = []
+
+    progress_bar = st.progress(0)
+    total_tables = len(tables)
+    executor = ThreadPoolExecutor(
+        max_workers=int(secret_setting("query_workers", DEFAULT_QUERY_WORKERS)),
+        initializer=attach_request_context,
+        initargs=(ctx, instrumentation.current_spans()),
+    )
+    futures = {executor.submit(fetch_table, table, polygon_geojson, srid_source, request, srids): table for table in tables}
+    pending = set(futures)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=0.25, return_when=FIRST_COMPLETED)
+            for future in done:
+                table = futures[future]
+                try:
+                    df, aggregate = future.result()
+                except cancellation.QueryTimedOut:
+                    statuses[table]['status'] = TABLE_TIMED_OUT
+                    continue
+                except cancellation.QuerySuperseded:
+                    statuses[table]['status'] = TABLE_CANCELLED
+                    continue
+                cells = None
+                if aggregate is not None:
+                    estimate, cells = aggregate
+                    statuses[table] = {'status': TABLE_AGGREGATED, 'rows': estimate}
+                    st.session_state.aggregates[table] = cells
+                else:
+                    statuses[table] = {'status': TABLE_OK, 'rows': len(df)}
+                if not df.empty:
+                    all_data.append(df)
+                if on_result is not None:
+                    on_result(table, df, cells)
+            progress_bar.progress((total_tables - len(pending)) / max(total_tables, 1))
+    finally:
+        request.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        cancellation.end_query_request(request)
+
+    if all_data:
+        return pd.concat(all_data, ignore_index=True)
+    else:
+        return pd.DataFrame()
+
+# Split tables into those that may intersect a polygon and those whose known extent rules it
+# out, before any per-table SQL. Extents are kept per process and recomputed in the background
+# after a table changes; until then, or while its change counter is unknown, the table is
+# queried. Disabled with extent_pruning = false.
+def prune_tables(tables, polygon_geojson, srid_source, srids=None):
+    import extents
+    import shapely
+
+    if not secret_setting("extent_pruning", True) or snapshot_path():
+        return tables, []
+    registry = extents.get_registry()
+    try:
+        registry.refresh_counters(get_connection, float(secret_setting("extent_check_interval", table_changes.DEFAULT_CHECK_INTERVAL)))
+    except Exception as e:
+        st.warning(f"Could not check tables for changes, querying every table: {e}")
+        return tables, []
+
+    polygon = shapely.from_geojson(polygon_geojson)
+    kept, skipped = [], []
+    with instrumentation.span('prune_tables') as span:
+        for table in tables:
+            srid, _ = table_srid(table, srid_source, srids)
+            if srid_source == SRID_FROM_METADATA and srid is None:
+                kept.append(table)
+                continue
+            extent = registry.get(get_connection, table, shape_4326(int(srid) if srid is not None else 'srid'))
+            if extent is None or extent.may_intersect(polygon):
+                kept.append(table)
+            else:
+                skipped.append(table)
+        span['rows'] = len(skipped)
+    return kept, skipped
+
+# Query geometries within a polygon for all relevant tables
+def query_geometries_within_polygon(polygon_geojson, srid_source=SRID_FROM_COLUMN, on_result=None):
+    tables = get_tables_with_shape_column()
+    if srid_source == SRID_FROM_METADATA:
+        ensure_table_to_layer_mapping(tables)
+    srids = table_srids(tables, srid_source)
+    tables, skipped = prune_tables(tables, polygon_geojson, srid_source, srids)
+    return run_table_queries(tables, polygon_geojson, srid_source, on_result, skipped, srids)
+
+# Function to query all geometries
+def query_all_geometries(srid_source=SRID_FROM_METADATA, on_result=None):
+    tables = get_tables_with_shape_column()
+    if srid_source == SRID_FROM_METADATA:
+        ensure_table_to_layer_mapping(tables)
+    return run_table_queries(tables, None, srid_source, on_result, srids=table_srids(tables, srid_source))
+
+# Per-table status and row counts of the last query
+def table_status_frame():
+    return pd.DataFrame([
+        {'table': table, 'status': status['status'], 'rows': status['rows']}
+        for table, status in st.session_state.get('table_status', {}).items()
+    ])
+
+# Show which tables of the last query timed out or were cancelled
+def render_table_status():
+    statuses = st.session_state.get('table_status')
+    if not statuses:
+        return
+    timed_out = [table for table, status in statuses.items() if status['status'] == TABLE_TIMED_OUT]
+    if timed_out:
+        st.warning(f"Results are partial, these tables timed out: {', '.join(timed_out)}")
+    with st.expander('Tables queried'):
+        st.dataframe(table_status_frame())
+
+# Stream geometries of all relevant tables in chunks, for exports.
+# Without a polygon every geometry is streamed, like query_all_geometries. With batch areas,
+# every feature is tagged with the areas it intersects.
+def iter_geometries(polygon_geojson=None, srid_source=SRID_FROM_COLUMN, chunk_size=None, areas=None):
+    import export
+
+    tables = get_tables_with_shape_column()
+    if srid_source == SRID_FROM_METADATA:
+        ensure_table_to_layer_mapping(tables)
+
+    srids = table_srids(tables, srid_source)
+
+    if snapshot_path():
+        chunk_size = chunk_size or export.DEFAULT_CHUNK_SIZE
+        for table in tables:
+            _, drawing_info = srids[table]
+            df = query_snapshot_table(table, polygon_geojson, drawing_info)
+            df['table_name'] = table
+            if areas:
+                match_areas(df, areas)
+            for start in range(0, len(df), chunk_size):
+                yield df.iloc[start:start + chunk_size]
+        return
+
+    conn = get_connection()
+    if conn is None:
+        return
+    try:
+        for table in tables:
+            srid, drawing_info = srids[table]
+            if srid_source == SRID_FROM_METADATA and srid is None:
+                continue
+            query = build_table_query(table, polygon_geojson, srid)
+            params = query_params(polygon_geojson, srid)
+            for df in export.iter_query_chunks(conn, query, chunk_size or export.DEFAULT_CHUNK_SIZE, params):
+                df['table_name'] = table
+                if srid is not None:
+                    df['srid'] = srid
+                    df['drawing_info'] = drawing_info
+                df = decode_wkb_geometries(df)
+                yield match_areas(df, areas) if areas else df
+            # Named cursors live inside a transaction, end it before the next table
+            conn.commit()
+    finally:
+        conn.close()
+
+# Extract style information from an ArcGIS drawing_info renderer
+def drawing_info_style(drawing_info):
+    if isinstance(drawing_info, str):
+        drawing_info = json.loads(drawing_info or '{}')
+    style = {}
+    if drawing_info and 'renderer' in drawing_info:
+        renderer = drawing_info['renderer']
+        if 'symbol' in renderer:
+            symbol = renderer['symbol']
+            if 'color' in symbol:
+                style['color'] = f"rgba({symbol['color'][0]},{symbol['color'][1]},{symbol['color'][2]},{symbol['color'][3] / 255})"
+            if 'outline' in symbol and 'color' in symbol['outline']:
+                style['outline_color'] = f"rgba({symbol['outline']['color'][0]},{symbol['outline']['color'][1]},{symbol['outline']['color'][2]},{symbol['outline']['color'][3] / 255})"
+    return style
+
+# Function to add geometries to map with coordinate transformation and styling
+def add_geometries_to_map(geojson_list, metadata_list, map_object, table_columns=None):
+    from shapely.geometry import shape
+    from shapely.ops import transform
+
+    if table_columns is None:
+        table_columns = popup_columns()
+    if use_parallel_build(len(metadata_list)):
+        return add_geometries_in_parallel(geojson_list, metadata_list, map_object, table_columns)
+    timer = instrumentation.StageTimer()
+    transformers = {}
+    for geojson, metadata in zip(geojson_list, metadata_list):
+        if 'srid' not in metadata:
+            continue
+
+        # Work on a copy, the records stay usable after rendering
+        metadata = dict(metadata)
+        srid = metadata.pop('srid')
+        table_name = metadata.pop('table_name')
+        with timer.time('decode_reproject', table_name):
+            style = drawing_info_style(metadata.pop('drawing_info', None))
+
+            # GeoJSON text, or a geometry already decoded from WKB
+            shapely_geom = shape(json.loads(geojson)) if isinstance(geojson, str) else geojson
+
+            if int(srid) == 4326:
+                transformed_geom = shapely_geom
+            else:
+                # Define the source and destination coordinate systems, once per SRID
+                if srid not in transformers:
+                    src_crs = pyproj.CRS(f"EPSG:{srid}")
+                    dst_crs = pyproj.CRS("EPSG:4326")
+                    transformers[srid] = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+
+                # Transform the geometry to the geographic coordinate system
+                transformed_geom = transform(transformers[srid].transform, shapely_geom)
+
+        # Remove the 'geometry' and 'SHAPE' fields from metadata for the popup
+        metadata.pop('geometry', None)
+        metadata.pop('SHAPE', None)
+
+        # Filter metadata to include only columns from the respective table
+        columns = table_columns.get(table_name, [])
+        filtered_metadata = {key: value for key, value in metadata.items() if key in columns and pd.notna(value) and value != ''}
+
+        # Create a popup with metadata (other columns)
+        with timer.time('popup', table_name):
+            metadata_html = f"<b>Table: {table_name}</b><br>" + "<br>".join([f"<b>{key}:</b> {value}" for key, value in filtered_metadata.items()])
+            popup = folium.Popup(metadata_html, max_width=300)
+
+        with timer.time('folium_layers', table_name):
+            if transformed_geom.geom_type == 'Point':
+                folium.Marker(location=[transformed_geom.y, transformed_geom.x], popup=popup).add_to(map_object)
+            elif transformed_geom.geom_type == 'LineString':
+                folium.PolyLine(locations=[(coord[1], coord[0]) for coord in transformed_geom.coords], popup=popup, color=style.get('color')).add_to(map_object)
+            elif transformed_geom.geom_type == 'Polygon':
+                folium.Polygon(locations=[(coord[1], coord[0]) for coord in transformed_geom.exterior.coords], popup=popup, color=style.get('color'), fill_color=style.get('outline_color')).add_to(map_object)
+            elif transformed_geom.geom_type == 'MultiLineString':
+                for line in transformed_geom.geoms:
+                    folium.PolyLine(locations=[(coord[1], coord[0]) for coord in line.coords], popup=popup, color=style.get('color')).add_to(map_object)
+            else:
+                st.write(f"Unsupported geometry type: {transformed_geom.geom_type}")
+    timer.flush()
+
+# Parallel feature building, enabled in the sidebar, pays off from parallel_build_threshold features
+def use_parallel_build(feature_count):
+    import parallel_build
+
+    if not session_setting('parallel_build', False):
+        return False
+    return feature_count >= int(secret_setting("parallel_build_threshold", parallel_build.DEFAULT_PARALLEL_THRESHOLD))
+
+# Same layers as add_geometries_to_map, with the decode, reprojection and popups of each chunk
+# of a table built in a process pool; each chunk comes back as one GeoJSON layer
+def add_geometries_in_parallel(geojson_list, metadata_list, map_object, table_columns):
+    import parallel_build
+
+    timer = instrumentation.StageTimer()
+    chunk_size = int(secret_setting("parallel_build_chunk_size", parallel_build.DEFAULT_CHUNK_SIZE))
+
+    # Group features by table, SRID and style, keeping only the popup columns of each table
+    groups = {}
+    with timer.time('pack', None):
+        for geojson, metadata in zip(geojson_list, metadata_list):
+            if 'srid' not in metadata or geojson is None:
+                continue
+            table_name = metadata['table_name']
+            drawing_info = metadata.get('drawing_info')
+            key = (table_name, int(metadata['srid']), drawing_info if isinstance(drawing_info, str) else json.dumps(drawing_info))
+            columns = [column for column in table_columns.get(table_name, []) if column not in ('geometry', 'SHAPE')]
+            attributes = {column: metadata[column] for column in columns if column in metadata and pd.notna(metadata[column])}
+            group = groups.setdefault(key, ([], []))
+            group[0].append(geojson)
+            group[1].append(attributes)
+
+        chunks, styles = [], []
+        for (table_name, srid, drawing_info), (geometries, rows) in groups.items():
+            style = drawing_info_style(drawing_info if drawing_info != 'null' else None)
+            for start in range(0, len(geometries), chunk_size):
+                chunks.append(parallel_build.pack_chunk(
+                    table_name, srid, geometries[start:start + chunk_size], rows[start:start + chunk_size]
+                ))
+                styles.append(style)
+
+    workers = secret_setting("build_workers")
+    with instrumentation.span('parallel_build') as span:
+        fragments = list(parallel_build.build_fragments(chunks, int(workers) if workers else None))
+        span['rows'] = sum(count for _, _, count in fragments)
+
+    for (table_name, fragment, _), style in zip(fragments, styles):
+        path_options = {key: value for key, value in (('color', style.get('color')), ('fillColor', style.get('outline_color'))) if value}
+        with timer.time('folium_layers', table_name):
+            folium.GeoJson(
+                fragment,
+                name=table_name,
+                style_function=lambda feature, path_options=path_options: path_options,
+                popup=folium.GeoJsonPopup(fields=['popup'], labels=False),
+                control=False,
+            ).add_to(map_object)
+    timer.flush()
+
+# Create a Folium map centered on Los Angeles
+def initialize_map(draw_export=False):
+    from folium.plugins import Draw
+
+    m = folium.Map(location=[34.0522, -118.2437], zoom_start=10)
+    draw = Draw(
+        export=draw_export,
+        filename='data.geojson',
+        position='topleft',
+        draw_options={'polyline': False, 'rectangle': False, 'circle': False, 'marker': False, 'circlemarker': False},
+        edit_options={'edit': False}
+    )
+    draw.add_to(m)
+    return m
+
+# Render backends: Leaflet through folium, or deck.gl through pydeck; Auto picks WebGL
+# above webgl_threshold features
+BACKEND_AUTO = 'Auto'
+BACKEND_LEAFLET = 'Leaflet'
+BACKEND_WEBGL = 'WebGL'
+
+# True when a result of this many features is drawn through WebGL
+def use_webgl(feature_count):
+    import webgl
+
+    backend = session_setting('render_backend', BACKEND_AUTO)
+    if backend == BACKEND_AUTO:
+        return feature_count > int(secret_setting("webgl_threshold", webgl.DEFAULT_WEBGL_THRESHOLD))
+    return backend == BACKEND_WEBGL
+
+# Replace the map with one showing the geometries of a query result and the grid counts of aggregated tables
+def show_results_on_map(df, draw_export=False):
+    st.session_state.geojson_list = df['geometry'].tolist() if not df.empty else []
+    st.session_state.metadata_list = df.to_dict(orient='records')
+
+    st.session_state.deck = None
+    if use_webgl(len(st.session_state.metadata_list)):
+        import webgl
+
+        # The Leaflet map stays on the page for drawing the next polygon, without earlier results
+        st.session_state.map = initialize_map(draw_export)
+
+        with instrumentation.span('build_deck') as span:
+            st.session_state.deck = webgl.build_deck(
+                st.session_state.metadata_list, popup_columns(), st.session_state.get('aggregates')
+            )
+            span['rows'] = len(st.session_state.metadata_list)
+        return
+
+    # Clear the existing map and reinitialize it
+    m = initialize_map(draw_export)
+    for table, cells in st.session_state.get('aggregates', {}).items():
+        aggregation.add_aggregate_layer(cells, table, m)
+    with instrumentation.span('add_geometries_to_map') as span:
+        add_geometries_to_map(st.session_state.geojson_list, st.session_state.metadata_list, m)
+        span['rows'] = len(st.session_state.metadata_list)
+    st.session_state.map = m
+
+# Seconds between two map previews while tables return; each preview re-renders and re-sends
+# the whole map, earlier layers included
+DEFAULT_PREVIEW_INTERVAL = 2.0
+
+# Features on the map above which it is no longer previewed until every table has returned
+DEFAULT_PREVIEW_FEATURE_LIMIT = 5000
+
+# Query tables and add each table's features to a new map as its own layer the moment that
+# table returns, previewing the map (at most every preview_interval seconds, and only up to
+# preview_feature_limit features) and the running per-table counts while the others still run.
+# Without a polygon every geometry is queried, like query_all_geometries.
+def query_progressively(polygon_geojson=None, srid_source=SRID_FROM_COLUMN, draw_export=False, areas=None):
+    from streamlit.components.v1 import html
+
+    m = initialize_map(draw_export)
+    preview = st.empty()
+    counts = st.empty()
+    start = time.perf_counter()
+    state = {'first_feature': False, 'previewed_at': None, 'features': 0}
+    interval = float(secret_setting("preview_interval", DEFAULT_PREVIEW_INTERVAL))
+    feature_limit = int(secret_setting("preview_feature_limit", DEFAULT_PREVIEW_FEATURE_LIMIT))
+
+    def show_preview():
+        now = time.perf_counter()
+        if state['features'] > feature_limit:
+            return
+        if state['previewed_at'] is not None and now - state['previewed_at'] < interval:
+            return
+        state['previewed_at'] = now
+        with instrumentation.span('preview'):
+            with preview.container():
+                html(m.get_root().render(), height=500)
+
+    def add_table_layer(table, df, cells):
+        if cells is not None:
+            aggregation.add_aggregate_layer(cells, table, m)
+            show_preview()
+        if not df.empty:
+            if areas:
+                tag_matched_areas(df, areas)
+            state['features'] += len(df)
+            # Once the result is bound for WebGL (Auto above webgl_threshold), Leaflet layers
+            # would only be thrown away at the end; the running counts still update
+            if not use_webgl(state['features']):
+                layer = folium.FeatureGroup(name=table)
+                with instrumentation.span('add_geometries_to_map', table) as span:
+                    add_geometries_to_map(df['geometry'].tolist(), df.to_dict(orient='records'), layer)
+                    span['rows'] = len(df)
+                layer.add_to(m)
+                if not state['first_feature']:
+                    state['first_feature'] = True
+                    instrumentation.record('time_to_first_feature', time.perf_counter() - start, table, len(df))
+                show_preview()
+        counts.dataframe(table_status_frame())
+
+    if polygon_geojson is None:
+        df = query_all_geometries(srid_source, add_table_layer)
+    else:
+        df = query_geometries_within_polygon(polygon_geojson, srid_source, add_table_layer)
+    preview.empty()
+    counts.empty()
+    st.session_state.query_records = df.to_dict(orient='records')
+
+    if use_webgl(len(df)):
+        # Too many features for Leaflet: the layers stopped being built once the running count
+        # passed the threshold
+        if not df.empty or st.session_state.aggregates:
+            show_results_on_map(df, draw_export)
+    elif not df.empty or st.session_state.aggregates:
+        folium.LayerControl().add_to(m)
+        st.session_state.map = m
+        st.session_state.deck = None
+        st.session_state.geojson_list = df['geometry'].tolist()
+        st.session_state.metadata_list = df.to_dict(orient='records')
+    return df
+
+# Query a polygon (or everything, without one) and put the results on the map,
+# progressively when enabled in the sidebar. With batch areas, every feature is tagged
+# with the areas it intersects.
+def query_and_show(polygon_geojson=None, srid_source=SRID_FROM_COLUMN, draw_export=False, areas=None):
+    st.session_state.spans = instrumentation.start_request()
+    st.session_state.draw_export = draw_export
+    if st.session_state.get('progressive_rendering') and session_setting('render_backend') != BACKEND_WEBGL:
+        return query_progressively(polygon_geojson, srid_source, draw_export, areas)
+
+    if polygon_geojson is None:
+        df = query_all_geometries(srid_source)
+    else:
+        df = query_geometries_within_polygon(polygon_geojson, srid_source)
+    if areas and not df.empty:
+        tag_matched_areas(df, areas)
+    st.session_state.query_records = df.to_dict(orient='records')
+    if not df.empty or st.session_state.aggregates:
+        show_results_on_map(df, draw_export)
+    return df
+
+# Areas of a batch query as (label, shapely geometry): every polygon drawn on the map, and
+# every polygon of an uploaded GeoJSON file (EPSG:4326), labelled by its name or id property
+def batch_areas(st_data, uploaded_file=None):
+    from shapely.geometry import shape
+
+    areas = []
+    for index, drawing in enumerate((st_data or {}).get('all_drawings') or [], 1):
+        geometry = drawing.get('geometry') or {}
+        if geometry.get('type') in ('Polygon', 'MultiPolygon'):
+            areas.append((f"drawn {index}", shape(geometry)))
+
+    if uploaded_file is not None:
+        data = json.load(uploaded_file)
+        if data.get('type') == 'FeatureCollection':
+            features = data['features']
+        elif data.get('type') == 'Feature':
+            features = [data]
+        else:
+            features = [{'type': 'Feature', 'geometry': data, 'properties': {}}]
+        for index, feature in enumerate(features, 1):
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') in ('Polygon', 'MultiPolygon'):
+                properties = feature.get('properties') or {}
+                areas.append((str(properties.get('name') or properties.get('id') or f"area {index}"), shape(geometry)))
+    return areas
+
+# Add a matched_areas column listing the batch areas each feature intersects. Rows without a
+# geometry or an srid match no area, as add_geometries_to_map skips them.
+def match_areas(df, areas):
+    import shapely
+
+    rows = (df['geometry'].notna() & df['srid'].notna()).to_numpy().nonzero()[0] if 'srid' in df.columns else []
+    matched = [[] for _ in range(len(df))]
+    if len(rows):
+        geometries = geometries_4326(df['geometry'].iloc[rows].tolist(), df['srid'].iloc[rows].tolist())
+        tree = shapely.STRtree([geometry for _, geometry in areas])
+        feature_index, area_index = tree.query(geometries, predicate='intersects')
+        for feature, area in zip(feature_index.tolist(), area_index.tolist()):
+            matched[rows[feature]].append(area)
+    df['matched_areas'] = [', '.join(areas[area][0] for area in sorted(indices)) for indices in matched]
+    return df
+
+# match_areas, with the column shown in the popups of the tables involved
+def tag_matched_areas(df, areas):
+    match_areas(df, areas)
+    extra = st.session_state.setdefault('extra_popup_columns', {})
+    for table in df['table_name'].unique():
+        if 'matched_areas' not in extra.get(table, []):
+            extra[table] = extra.get(table, []) + ['matched_areas']
+    return df
+
+# Query several areas in one pass: every table is queried once against their union, so a
+# feature hitting several areas comes back once, tagged with all of them
+def query_batch(areas, srid_source=SRID_FROM_COLUMN, draw_export=False):
+    import shapely
+    from shapely.geometry import mapping
+
+    union = shapely.union_all([geometry for _, geometry in areas])
+    # Kept for the "Batch areas" export scope
+    st.session_state.batch_areas = areas
+    df = query_and_show(json.dumps(mapping(union)), srid_source, draw_export, areas)
+    # The map is only replaced when there are results; the areas go on that new map
+    if (not df.empty or st.session_state.aggregates) and st.session_state.get('deck') is None:
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': [
+                {'type': 'Feature', 'geometry': mapping(geometry), 'properties': {'label': label}}
+                for label, geometry in areas
+            ]},
+            name='Batch areas',
+            style_function=lambda feature: {'color': '#444444', 'weight': 2, 'fillOpacity': 0.05},
+            tooltip=folium.GeoJsonTooltip(fields=['label'], labels=False),
+        ).add_to(st.session_state.map)
+    return df
+
+# Batch query controls: an optional GeoJSON upload and a button querying every drawn or
+# uploaded area at once. Returns the results when the button was pressed, otherwise None.
+def render_batch_controls(st_data, srid_source=SRID_FROM_COLUMN, draw_export=False):
+    uploaded_file = st.file_uploader('Batch areas (GeoJSON)', type=['geojson', 'json'])
+    try:
+        areas = batch_areas(st_data, uploaded_file)
+    except (ValueError, KeyError, AttributeError, TypeError) as e:
+        st.error(f"Could not read the uploaded areas: {e}")
+        return None
+    if not areas or not st.button(f'Query All Areas ({len(areas)})'):
+        return None
+    try:
+        df = query_batch(areas, srid_source, draw_export)
+        if no_results(df):
+            st.write("No geometries found within the areas.")
+        return df
+    except Exception as e:
+        st.error(f"Error: {e}")
+        return None
+
+# True when the last query returned neither features nor aggregated tables
+def no_results(df):
+    return df.empty and not st.session_state.get('aggregates')
+
+# Once the user zooms in far enough, replace aggregated tables by their raw features in the
+# current view, as long as the view holds few enough of them
+def drill_down(st_data, srid_source=SRID_FROM_COLUMN, draw_export=False):
+    from shapely.geometry import mapping, shape
+
+    if not st.session_state.get('aggregates') or not st_data or not st_data.get('bounds'):
+        return
+    zoom = st_data.get('zoom') or 0
+    if zoom < int(secret_setting("drill_down_zoom", aggregation.DEFAULT_DRILL_DOWN_ZOOM)):
+        return
+    view = aggregation.viewport_polygon(st_data['bounds'])
+    view_key = json.dumps(view)
+    if st.session_state.get('drilled_view') == view_key:
+        return
+    st.session_state.drilled_view = view_key
+
+    # Stay within the polygon the aggregated query was made for
+    view_geometry = shape(view)
+    if st.session_state.get('aggregate_polygon'):
+        view_geometry = view_geometry.intersection(shape(json.loads(st.session_state.aggregate_polygon)))
+        if view_geometry.is_empty:
+            return
+    view_geojson = json.dumps(mapping(view_geometry))
+
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    frames = []
+    srids = table_srids(list(st.session_state.aggregates), srid_source)
+    # Under the same statement timeout, cancellation and feature budget as a fan-out
+    request = begin_query_request(get_script_run_ctx())
+    try:
+        for table in st.session_state.aggregates:
+            try:
+                df, aggregate = fetch_table(table, view_geojson, srid_source, request, srids)
+            except (cancellation.QueryTimedOut, cancellation.QuerySuperseded):
+                continue
+            if aggregate is None and not df.empty:
+                frames.append(df)
+    finally:
+        cancellation.end_query_request(request)
+    if not frames:
+        return
+
+    center = st_data.get('center') or {}
+    show_results_on_map(pd.concat(frames + [pd.DataFrame(st.session_state.get('query_records', []))], ignore_index=True), draw_export)
+    if center:
+        st.session_state.map.location = [center['lat'], center['lng']]
+        st.session_state.map.options['zoom'] = zoom
+    st.rerun()
+
+# Display a map with Streamlit-Folium; the results map is drawn through WebGL instead when
+# show_results_on_map built a deck for it, and then returns no map state. The drawing map
+# ("initial_map") always stays a Leaflet map, so polygons can still be drawn and returned.
+def render_map(map_object, key):
+    from streamlit_folium import st_folium
+
+    if key != 'initial_map' and map_object is st.session_state.get('map') and st.session_state.get('deck') is not None:
+        with instrumentation.span('pydeck_chart'):
+            st.pydeck_chart(st.session_state.deck)
+        return None
+    with instrumentation.span('st_folium'):
+        return st_folium(map_object, width=700, height=500, key=key)
+
+# Sidebar toggles for progressive rendering, the debug panel and diagnostics mode,
+# plus instrumentation configured in secrets
+def render_sidebar():
+    st.session_state.progressive_rendering = st.sidebar.checkbox('Progressive rendering')
+    st.session_state.show_debug_panel = st.sidebar.checkbox('Show debug panel')
+    st.session_state.diagnostics_mode = st.sidebar.checkbox('Diagnostics mode')
+    st.session_state.parallel_build = st.sidebar.checkbox('Parallel feature building')
+    backend = st.sidebar.radio('Render backend', [BACKEND_AUTO, BACKEND_LEAFLET, BACKEND_WEBGL], horizontal=True)
+    backend_changed = backend != st.session_state.get('render_backend', backend)
+    st.session_state.render_backend = backend
+    st.session_state.slow_query_threshold = float(secret_setting("slow_query_threshold", diagnostics.DEFAULT_SLOW_QUERY_THRESHOLD))
+
+    instrumentation.start_request(st.session_state.spans)
+    if secret_setting("instrumentation_json_logs"):
+        instrumentation.configure_json_logging()
+    if secret_setting("instrumentation_trace_memory"):
+        instrumentation.enable_memory_tracing()
+    if secret_setting("metrics_port"):
+        instrumentation.start_metrics_server(int(secret_setting("metrics_port")))
+
+    # Results on the map were drawn for the previous backend, draw them again
+    if backend_changed and (st.session_state.get('query_records') or st.session_state.get('aggregates')):
+        show_results_on_map(pd.DataFrame(st.session_state.get('query_records', [])), st.session_state.get('draw_export', False))
+
+# Show the debug and diagnostics panels enabled in the sidebar
+def render_debug_panels():
+    if st.session_state.get('show_debug_panel'):
+        instrumentation.render_debug_panel(st.session_state.spans)
+    if st.session_state.get('diagnostics_mode'):
+        diagnostics.render_diagnostics_panel(diagnostics.slow_queries())
+    if st.session_state.get('show_debug_panel') and secret_setting("result_cache_mb"):
+        import result_cache
+
+        st.subheader('Shared result cache')
+        metrics = result_cache.metrics()
+        if metrics is not None:
+            st.write({name: metrics[name] for name in ('entries', 'hits', 'misses', 'evictions', 'invalidations')})
+            st.caption(f"Hit rate {metrics['hit_rate']:.0%}, {metrics['bytes'] / 2 ** 20:.1f} MB held")
+    if st.session_state.get('show_debug_panel') and secret_setting("indexed_tables"):
+        import spatial_index
+
+        st.subheader('In-memory spatial indexes')
+        footprints = spatial_index.footprints()
+        if footprints:
+            df = pd.DataFrame(footprints)
+            df['MB'] = (df['bytes'] / 2 ** 20).round(1)
+            st.dataframe(df.drop(columns=['bytes']))
+            st.caption(f"Total: {df['bytes'].sum() / 2 ** 20:.1f} MB")
+        else:
+            st.write('No index loaded yet.')
+
+# Stream query results to a file download
+def render_export_controls(srid_source=SRID_FROM_COLUMN, allow_all=False):
+    import export
+
+    import shapely
+    from shapely.geometry import mapping
+
+    scopes = ['Drawn polygon', 'All geometries'] if allow_all else ['Drawn polygon']
+    areas = st.session_state.get('batch_areas')
+    if areas:
+        scopes.append('Batch areas')
+    export_scope = st.radio('Export', scopes, horizontal=True) if len(scopes) > 1 else scopes[0]
+    export_format = st.selectbox('Export format', list(export.EXPORT_FORMATS))
+    if st.button('Export Query Results'):
+        if export_scope == 'Drawn polygon' and 'polygon_geojson' not in st.session_state:
+            st.error("Draw a polygon before exporting its results.")
+        else:
+            try:
+                with st.spinner('Exporting...'):
+                    if export_scope == 'Batch areas':
+                        # The union of the last batch, features tagged as on the map
+                        polygon_geojson = json.dumps(mapping(shapely.union_all([geometry for _, geometry in areas])))
+                        chunks = iter_geometries(polygon_geojson, srid_source, areas=areas)
+                    else:
+                        polygon_geojson = st.session_state.polygon_geojson if export_scope == 'Drawn polygon' else None
+                        chunks = iter_geometries(polygon_geojson, srid_source)
+                    discard_export()
+                    path = export.export_to_tempfile(chunks, export_format)
+                    st.session_state.export_file = export.ExportFile(path, export_format)
+            except Exception as e:
+                st.error(f"Export error: {e}")
+
+    export_file = st.session_state.get('export_file')
+    if export_file is not None and export_file.exists():
+        suffix, mime = export.EXPORT_FORMATS[export_file.export_format]
+        with open(export_file.path, 'rb') as f:
+            st.download_button(
+                "Download Export",
+                f,
+                f"query_results{suffix}",
+                mime,
+                key='download-export',
+                on_click=discard_export,
+            )
+
+# Delete the session's export file; the download button keeps its own copy once rendered
+def discard_export():
+    export_file = st.session_state.pop('export_file', None)
+    if export_file is not None:
+        export_file.discard()
+
+# Function to create ArcGIS webmap
+def create_arcgis_webmap(df):
+    from arcgis.gis import GIS
+    from arcgis.features import GeoAccessor  # registers the DataFrame.spatial accessor
+    from arcgis.mapping import WebMap
+
+    gis = GIS("https://www.arcgis.com", st.secrets["arcgis_username"], st.secrets["arcgis_password"])
+
+    w = WebMap()
+    x=st.write(df.head(2))
+    # Ensure the DataFrame is spatially enabled
+    def format_geometry(geom, srid):
+        if isinstance(geom, str):
+            geom = json.loads(geom)
+        if geom['type'] == 'Point':
+            return {"spatialReference": {"wkid": srid}, "x": geom['coordinates'][0], "y": geom['coordinates'][1]}
+        elif geom['type'] == 'LineString':
+            return {"spatialReference": {"wkid": srid}, "paths": [geom['coordinates']]}
+        elif geom['type'] == 'Polygon':
+            return {"spatialReference": {"wkid": srid}, "rings": geom['coordinates']}
+        elif geom['type'] == 'MultiLineString':
+            return {"spatialReference": {"wkid": srid}, "paths": geom['coordinates']}
+        else:
+            return geom
+
+    # With WKB transfer there is no SHAPE column, the geometry is already decoded in EPSG:4326
+    if 'SHAPE' not in df.columns:
+        from shapely.geometry import mapping
+        df['SHAPE'] = df['geometry'].apply(lambda geometry: mapping(geometry) if geometry is not None else None)
+
+    # Apply format_geometry to the 'geometry' column
+    df['geometry'] = df.apply(lambda row: format_geometry(row['SHAPE'], row['srid']) if pd.notna(row['SHAPE']) and pd.notna(row['srid']) else None, axis=1)
+
+    # Check for and handle NaN values in 'geometry' column
+    df = df.dropna(subset=['geometry'])
+
+    @st.cache_data
+    def convert_df(df):
+        st.write(df.head())
+        return df.to_csv(index=False).encode('utf-8')
+
+    csv = convert_df(x)
+    st.download_button(
+        "Press to Download",
+        csv,
+        "file.csv",
+        "text/csv",
+        key='download-csv'
+    )
+
+    df = pd.read_csv(csv)
+    sdf = pd.DataFrame.spatial.from_df(df, geometry_column='geometry')
+    w.add_layer(df)
+    w.save({'title': 'test_map2', 'snippet': 'test map', 'tags': 'test'})
+
+    # Debugging: Check DataFrame before conversion
+    st.write(df.head())
+
+    st.success(f"Webmap created successfully!")
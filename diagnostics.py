@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+from collections import deque
+
+from psycopg2 import sql
+
+# Per-table queries slower than this (seconds) are captured with EXPLAIN ANALYZE
+DEFAULT_SLOW_QUERY_THRESHOLD = 1.0
+
+# Number of slow queries kept in the rolling log
+SLOW_LOG_SIZE = 200
+
+_slow_log = deque(maxlen=SLOW_LOG_SIZE)
+_lock = threading.Lock()
+
+# Run a query under EXPLAIN (ANALYZE, BUFFERS) and return the JSON plan
+def capture_explain(conn, query):
+    with conn.cursor() as cursor:
+        cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query.strip().rstrip(';'))
+        plan = cursor.fetchone()[0]
+    conn.rollback()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return plan[0]
+
+# Walk every node of a plan tree
+def iter_plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+# Summarize how a plan read the table: scan type, index used, rows the filter ran on, buffers
+def analyze_plan(plan, table_name):
+    analysis = {
+        'seq_scan': False,
+        'index': None,
+        'rows_transformed': 0,
+        'rows_returned': 0,
+        'shared_hit_blocks': 0,
+        'shared_read_blocks': 0,
+        'execution_time_ms': plan.get('Execution Time'),
+    }
+    for node in iter_plan_nodes(plan['Plan']):
+        if node.get('Relation Name') != table_name:
+            continue
+        loops = node.get('Actual Loops', 1)
+        rows = node.get('Actual Rows', 0) * loops
+        removed = node.get('Rows Removed by Filter', 0) * loops
+        analysis['rows_returned'] += rows
+        analysis['shared_hit_blocks'] += node.get('Shared Hit Blocks', 0)
+        analysis['shared_read_blocks'] += node.get('Shared Read Blocks', 0)
+        if node['Node Type'] == 'Seq Scan':
+            # The ST_Transform in the filter runs once for every row the scan visits
+            analysis['seq_scan'] = True
+            analysis['rows_transformed'] += rows + removed
+        elif 'Index Name' in node:
+            analysis['index'] = node['Index Name']
+            analysis['rows_transformed'] += rows + removed + node.get('Rows Removed by Index Recheck', 0) * loops
+    return analysis
+
+# Suggest the index or materialized column that lets the intersect use a GiST index.
+# geometry_expression is the expression the query intersects, e.g. the ST_Transform(...) of "SHAPE".
+# Table and index names are quoted identifiers, rendered for the connection.
+def advise(conn, table_name, analysis, geometry_expression):
+    if not analysis['seq_scan']:
+        return None
+    table = sql.Identifier('public', table_name)
+    geometry = sql.SQL(geometry_expression)
+    return {
+        'expression_index': sql.SQL(
+            'CREATE INDEX CONCURRENTLY {index} ON {table} USING gist (({geometry}));'
+        ).format(
+            index=sql.Identifier(f'{table_name}_shape_4326_gist'), table=table, geometry=geometry,
+        ).as_string(conn),
+        'materialized_column': sql.SQL(
+            'ALTER TABLE {table} ADD COLUMN geom_4326 geometry GENERATED ALWAYS AS ({geometry}) STORED; '
+            'CREATE INDEX CONCURRENTLY {index} ON {table} USING gist (geom_4326);'
+        ).format(
+            index=sql.Identifier(f'{table_name}_geom_4326_gist'), table=table, geometry=geometry,
+        ).as_string(conn),
+    }
+
+# Capture the plan of a slow per-table query and add it to the rolling slow-query log
+def record_slow_query(conn, table_name, query, seconds, geometry_expression):
+    plan = capture_explain(conn, query)
+    analysis = analyze_plan(plan, table_name)
+    entry = {
+        'table': table_name,
+        'seconds': seconds,
+        'timestamp': time.time(),
+        'analysis': analysis,
+        'advice': advise(conn, table_name, analysis, geometry_expression),
+        'plan': plan,
+    }
+    with _lock:
+        _slow_log.append(entry)
+    return entry
+
+# Snapshot of the rolling slow-query log, newest first
+def slow_queries():
+    with _lock:
+        return list(reversed(_slow_log))
+
+# Latest diagnosis per table, slowest tables first
+def table_report(entries=None):
+    latest = {}
+    for entry in entries if entries is not None else slow_queries():
+        latest.setdefault(entry['table'], entry)
+    return sorted(latest.values(), key=lambda entry: entry['seconds'], reverse=True)
+
+# Show the per-table report and the slow-query log in Streamlit
+def render_diagnostics_panel(entries):
+    import pandas as pd
+    import streamlit as st
+
+    with st.expander('Diagnostics: slow queries', expanded=True):
+        if not entries:
+            st.write("No slow queries captured yet.")
+            return
+        report = table_report(entries)
+        st.dataframe(pd.DataFrame([
+            {
+                'table': entry['table'],
+                'seconds': entry['seconds'],
+                'seq_scan': entry['analysis']['seq_scan'],
+                'index': entry['analysis']['index'],
+                'rows_transformed': entry['analysis']['rows_transformed'],
+                'rows_returned': entry['analysis']['rows_returned'],
+                'shared_read_blocks': entry['analysis']['shared_read_blocks'],
+            }
+            for entry in report
+        ]))
+        for entry in report:
+            if entry['advice']:
+                st.write(f"**{entry['table']}**: sequential scan over {entry['analysis']['rows_transformed']} transformed rows. Fix with:")
+                st.code(entry['advice']['expression_index'], language='sql')
+                st.write("or a materialized 4326 column (queries must then intersect `geom_4326`):")
+                st.code(entry['advice']['materialized_column'], language='sql')
+        st.download_button("Download slow-query log (JSON)", json.dumps(entries, indent=2, default=str), "slow_queries.json", "application/json", key='download-slow-queries')
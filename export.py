@@ -0,0 +1,168 @@
+import json
+import os
+import tempfile
+import weakref
+
+from core import lazy_import
+
+pd = lazy_import('pandas')
+pyproj = lazy_import('pyproj')
+
+# Rows fetched per round trip when streaming query results
+DEFAULT_CHUNK_SIZE = 5000
+
+# Supported export formats: file suffix and mime type for the download button
+EXPORT_FORMATS = {
+    'GeoParquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'FlatGeobuf': ('.fgb', 'application/octet-stream'),
+    'GeoJSONSeq': ('.geojsonl', 'application/geo+json-seq'),
+}
+
+# Columns that describe the geometry rather than the feature itself
+GEOMETRY_COLUMNS = ('SHAPE', 'geometry', 'srid', 'drawing_info', 'table_name')
+
+# Stream the rows of a query in chunks through a server-side (named) cursor
+def iter_query_chunks(conn, query, chunk_size=DEFAULT_CHUNK_SIZE, params=None):
+    cursor = conn.cursor(name='export_cursor')
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            columns = [desc[0] for desc in cursor.description]
+            df = pd.DataFrame(rows, columns=columns)
+
+            # Ensure no duplicate columns
+            yield df.loc[:, ~df.columns.duplicated()]
+    finally:
+        cursor.close()
+
+# Cache one transformer per source SRID, every export is written in EPSG:4326
+def get_transformer(srid, transformers):
+    if srid not in transformers:
+        src_crs = pyproj.CRS(f"EPSG:{srid}")
+        dst_crs = pyproj.CRS("EPSG:4326")
+        transformers[srid] = pyproj.Transformer.from_crs(src_crs, dst_crs, always_xy=True)
+    return transformers[srid]
+
+# Turn a chunk of query results into (table_name, attributes, geometry) tuples in EPSG:4326
+def iter_chunk_features(df, transformers):
+    from shapely.geometry import shape
+    from shapely.ops import transform
+
+    for record in df.to_dict(orient='records'):
+        geometry = record.get('geometry')
+        srid = record.get('srid')
+        if geometry is None or pd.isna(srid):
+            continue
+
+        # GeoJSON text, or a geometry already decoded from WKB
+        if isinstance(geometry, str):
+            geometry = shape(json.loads(geometry))
+        if int(srid) != 4326:
+            geometry = transform(get_transformer(int(srid), transformers).transform, geometry)
+        attributes = {key: value for key, value in record.items()
+                      if key not in GEOMETRY_COLUMNS and pd.notna(value) and value != ''}
+        yield record.get('table_name', ''), attributes, geometry
+
+# Write chunks as newline-delimited GeoJSON, one feature per line
+def write_geojsonseq(chunks, path):
+    from shapely.geometry import mapping
+
+    transformers = {}
+    with open(path, 'w', encoding='utf-8') as f:
+        for df in chunks:
+            for table_name, attributes, geometry in iter_chunk_features(df, transformers):
+                feature = {
+                    'type': 'Feature',
+                    'geometry': mapping(geometry),
+                    'properties': dict(attributes, table_name=table_name),
+                }
+                f.write(json.dumps(feature, default=str) + '\n')
+
+# Write chunks as GeoParquet, one row group per chunk
+def write_geoparquet(chunks, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Tables have different columns, so the attributes travel as a JSON column
+    geo_metadata = {
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {'encoding': 'WKB', 'geometry_types': []}},
+    }
+    schema = pa.schema(
+        [('table_name', pa.string()), ('attributes', pa.string()), ('geometry', pa.binary())],
+        metadata={'geo': json.dumps(geo_metadata)},
+    )
+
+    transformers = {}
+    with pq.ParquetWriter(path, schema) as writer:
+        for df in chunks:
+            table_names, attributes_list, geometries = [], [], []
+            for table_name, attributes, geometry in iter_chunk_features(df, transformers):
+                table_names.append(table_name)
+                attributes_list.append(json.dumps(attributes, default=str))
+                geometries.append(geometry.wkb)
+            if geometries:
+                writer.write_table(pa.table([table_names, attributes_list, geometries], schema=schema))
+
+# Write chunks as FlatGeobuf; GDAL builds the packed spatial index when the file is closed
+def write_flatgeobuf(chunks, path):
+    import fiona
+    from shapely.geometry import mapping
+
+    schema = {'geometry': 'Unknown', 'properties': {'table_name': 'str', 'attributes': 'str'}}
+    transformers = {}
+    with fiona.open(path, 'w', driver='FlatGeobuf', schema=schema, crs='EPSG:4326', SPATIAL_INDEX='YES') as dst:
+        for df in chunks:
+            dst.writerecords([
+                {
+                    'geometry': mapping(geometry),
+                    'properties': {'table_name': table_name, 'attributes': json.dumps(attributes, default=str)},
+                }
+                for table_name, attributes, geometry in iter_chunk_features(df, transformers)
+            ])
+
+WRITERS = {
+    'GeoParquet': write_geoparquet,
+    'FlatGeobuf': write_flatgeobuf,
+    'GeoJSONSeq': write_geojsonseq,
+}
+
+# Stream chunks into a temporary file in the requested format and return its path
+def export_to_tempfile(chunks, export_format):
+    suffix, _ = EXPORT_FORMATS[export_format]
+    fd, path = tempfile.mkstemp(prefix='export_', suffix=suffix)
+    os.close(fd)
+    try:
+        # FlatGeobuf refuses to overwrite an existing file
+        os.remove(path)
+        WRITERS[export_format](chunks, path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    return path
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# A temporary export file, deleted when discarded, when the session holding it ends and it
+# is garbage collected, or at interpreter exit
+class ExportFile:
+    def __init__(self, path, export_format):
+        self.path = path
+        self.export_format = export_format
+        self.finalizer = weakref.finalize(self, remove_file, path)
+
+    def exists(self):
+        return self.finalizer.alive and os.path.exists(self.path)
+
+    def discard(self):
+        self.finalizer()
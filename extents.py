@@ -0,0 +1,146 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql
+
+import instrumentation
+import table_changes
+
+# Cells per side of the occupancy grid laid over each table's extent
+GRID_SIZE = 32
+
+# Extent of one table in EPSG:4326 and the grid cells its geometries' bounding boxes touch,
+# valid while the table's change counters stay at the values they had when it was computed
+class TableExtent:
+    def __init__(self, bounds, cells, counter):
+        self.bounds = bounds
+        self.cells = cells
+        self.counter = counter
+
+    # Boxes of the occupied cells, grown by pad times their size
+    def cell_boxes(self, pad=0.0):
+        import shapely
+
+        west, south, east, north = self.bounds
+        if self.cells is None:
+            return [shapely.box(west, south, east, north)]
+        dx = (east - west) / GRID_SIZE or 1e-9
+        dy = (north - south) / GRID_SIZE or 1e-9
+        pad_x, pad_y = dx * pad, dy * pad
+        return [
+            shapely.box(west + i * dx - pad_x, south + j * dy - pad_y, west + (i + 1) * dx + pad_x, south + (j + 1) * dy + pad_y)
+            for i, j in self.cells
+        ]
+
+    # False only when no geometry of the table can intersect the polygon: the polygon misses
+    # the extent, or every occupied cell. Tables without geometries never match.
+    def may_intersect(self, polygon):
+        import shapely
+
+        if self.bounds is None:
+            return False
+        west, south, east, north = self.bounds
+        if not polygon.intersects(shapely.box(west, south, east, north)):
+            return False
+        # Cells are padded slightly so rounding at their edges cannot drop a touching geometry
+        return bool(shapely.intersects(self.cell_boxes(1e-6), polygon).any())
+
+    # Share of the table's geometries expected inside the polygon, taking them as spread evenly
+    # over the occupied cells: the part of the occupied area the polygon covers
+    def overlap_share(self, polygon):
+        import shapely
+
+        if self.bounds is None:
+            return 0.0
+        boxes = self.cell_boxes()
+        total = float(shapely.area(boxes).sum())
+        if total <= 0:
+            return 1.0 if self.may_intersect(polygon) else 0.0
+        return min(1.0, float(shapely.area(shapely.intersection(boxes, polygon)).sum()) / total)
+
+# Extent of a table and the occupancy grid over it, computed on the server
+def compute_extent(conn, table_name, geometry_expression, counter):
+    table = sql.Identifier('public', table_name)
+    geometry = sql.SQL(geometry_expression)
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            SELECT ST_XMin(extent), ST_YMin(extent), ST_XMax(extent), ST_YMax(extent)
+            FROM (SELECT ST_Extent({geometry}) AS extent FROM {table} WHERE "SHAPE" IS NOT NULL) e;
+        """).format(geometry=geometry, table=table))
+        bounds = cursor.fetchone()
+        if bounds is None or bounds[0] is None:
+            return TableExtent(None, None, counter)
+
+        west, south, east, north = bounds
+        dx = (east - west) / GRID_SIZE or 1e-9
+        dy = (north - south) / GRID_SIZE or 1e-9
+        cursor.execute(sql.SQL("""
+            SELECT DISTINCT
+                floor((ST_XMin(g) - %(west)s) / %(dx)s)::int, floor((ST_XMax(g) - %(west)s) / %(dx)s)::int,
+                floor((ST_YMin(g) - %(south)s) / %(dy)s)::int, floor((ST_YMax(g) - %(south)s) / %(dy)s)::int
+            FROM (SELECT {geometry} AS g FROM {table} WHERE "SHAPE" IS NOT NULL) rows;
+        """).format(geometry=geometry, table=table), {'west': west, 'south': south, 'dx': dx, 'dy': dy})
+        cells = set()
+        for x0, x1, y0, y1 in cursor.fetchall():
+            for i in range(max(x0, 0), min(x1, GRID_SIZE - 1) + 1):
+                for j in range(max(y0, 0), min(y1, GRID_SIZE - 1) + 1):
+                    cells.add((i, j))
+    return TableExtent(tuple(bounds), cells, counter)
+
+# Extents of every table, keyed by (table, geometry expression), computed in the background
+# and dropped when a table's change counters move. Tables without counters get no extent.
+class ExtentRegistry:
+    def __init__(self):
+        self.extents = {}
+        self.changes = table_changes.ChangeCounters()
+        self.pending = set()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='extents')
+        self.lock = threading.Lock()
+
+    def refresh_counters(self, get_connection, interval=table_changes.DEFAULT_CHECK_INTERVAL):
+        self.changes.refresh(get_connection, interval)
+
+    # The table's extent when it is known and current; otherwise None, and it is computed in
+    # the background for a later query. None as well while the table's counter is unknown.
+    def get(self, get_connection, table_name, geometry_expression):
+        key = (table_name, geometry_expression)
+        counter = self.changes.get(table_name)
+        if counter is None:
+            return None
+        with self.lock:
+            extent = self.extents.get(key)
+            if extent is not None and extent.counter == counter:
+                return extent
+            if key in self.pending:
+                return None
+            self.pending.add(key)
+        self.executor.submit(self.compute, get_connection, key, counter)
+        return None
+
+    def compute(self, get_connection, key, counter):
+        try:
+            conn = get_connection()
+            if conn is None:
+                return
+            try:
+                extent = compute_extent(conn, key[0], key[1], counter)
+            finally:
+                conn.close()
+            with self.lock:
+                self.extents[key] = extent
+        except Exception as e:
+            instrumentation.logger.warning(f"Could not compute the extent of table {key[0]}: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+_registry = None
+_lock = threading.Lock()
+
+# The process-wide registry, created on first use
+def get_registry():
+    global _registry
+    with _lock:
+        if _registry is None:
+            _registry = ExtentRegistry()
+        return _registry
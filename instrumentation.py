@@ -0,0 +1,169 @@
+import json
+import logging
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger('instrumentation')
+
+# Wall time buckets (seconds) for the Prometheus histograms
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_local = threading.local()
+_lock = threading.Lock()
+_metrics = {}
+_metrics_server = None
+_trace_memory = False
+_collectors = []
+
+# Emit every span as one JSON line on stderr, once per process
+def configure_json_logging(level=logging.INFO):
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(level)
+        logger.propagate = False
+
+# Turn on memory tracking; tracemalloc slows allocations down, so it is opt-in
+def enable_memory_tracing():
+    global _trace_memory
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _trace_memory = True
+
+# Spans kept per request for the debug panel, older ones are dropped
+MAX_SPANS = 1000
+
+# Start collecting spans in this thread, into a new list or one kept from a previous script run
+def start_request(spans=None):
+    _local.spans = [] if spans is None else spans
+    return _local.spans
+
+# Spans recorded since the last start_request() in this thread
+def current_spans():
+    return getattr(_local, 'spans', [])
+
+# Record a finished span: keep it for the debug panel, log it and aggregate it
+def record(stage, seconds, table=None, rows=None, bytes_fetched=None, memory_delta=None):
+    span = {'stage': stage, 'table': table, 'seconds': seconds, 'rows': rows,
+            'bytes': bytes_fetched, 'memory_delta': memory_delta, 'timestamp': time.time()}
+    spans = current_spans()
+    spans.append(span)
+    del spans[:-MAX_SPANS]
+    logger.info(json.dumps(span))
+
+    with _lock:
+        metric = _metrics.setdefault(stage, {'count': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0, 'buckets': [0] * len(BUCKETS)})
+        metric['count'] += 1
+        metric['seconds'] += seconds
+        metric['rows'] += rows or 0
+        metric['bytes'] += bytes_fetched or 0
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                metric['buckets'][idx] += 1
+    return span
+
+# Time a block of code; the yielded dict lets the caller fill in rows and bytes. With memory
+# tracing, the span also records the traced memory still held at its exit compared to its
+# entry, i.e. what the span kept alive (the process-wide peak cannot be split between spans
+# that overlap across threads).
+@contextmanager
+def span(stage, table=None):
+    info = {'rows': None, 'bytes': None}
+    start_memory = tracemalloc.get_traced_memory()[0] if _trace_memory else None
+    start = time.perf_counter()
+    try:
+        yield info
+    finally:
+        seconds = time.perf_counter() - start
+        memory_delta = tracemalloc.get_traced_memory()[0] - start_memory if start_memory is not None else None
+        record(stage, seconds, table, info['rows'], info['bytes'], memory_delta)
+
+# Accumulate time per (stage, table) inside a loop and record one span per pair at the end
+class StageTimer:
+    def __init__(self):
+        self.totals = {}
+
+    @contextmanager
+    def time(self, stage, table):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            total = self.totals.setdefault((stage, table), [0.0, 0])
+            total[0] += time.perf_counter() - start
+            total[1] += 1
+
+    def flush(self):
+        for (stage, table), (seconds, rows) in self.totals.items():
+            record(stage, seconds, table, rows)
+        self.totals = {}
+
+# Add a function returning more metrics in the Prometheus text format to /metrics
+def register_collector(collector):
+    with _lock:
+        if collector not in _collectors:
+            _collectors.append(collector)
+
+# Render the aggregated spans in the Prometheus text exposition format
+def render_prometheus():
+    lines = [
+        '# HELP map_stage_seconds Wall time spent per stage.',
+        '# TYPE map_stage_seconds histogram',
+    ]
+    with _lock:
+        metrics = {stage: dict(metric, buckets=list(metric['buckets'])) for stage, metric in _metrics.items()}
+    for stage, metric in sorted(metrics.items()):
+        for bound, count in zip(BUCKETS, metric['buckets']):
+            lines.append(f'map_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'map_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {metric["count"]}')
+        lines.append(f'map_stage_seconds_sum{{stage="{stage}"}} {metric["seconds"]}')
+        lines.append(f'map_stage_seconds_count{{stage="{stage}"}} {metric["count"]}')
+    lines += ['# HELP map_stage_rows_total Rows processed per stage.', '# TYPE map_stage_rows_total counter']
+    lines += [f'map_stage_rows_total{{stage="{stage}"}} {metric["rows"]}' for stage, metric in sorted(metrics.items())]
+    lines += ['# HELP map_stage_bytes_total Bytes fetched per stage.', '# TYPE map_stage_bytes_total counter']
+    lines += [f'map_stage_bytes_total{{stage="{stage}"}} {metric["bytes"]}' for stage, metric in sorted(metrics.items())]
+    with _lock:
+        collectors = list(_collectors)
+    return '\n'.join(lines) + '\n' + ''.join(collector() for collector in collectors)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics on a background thread, once per process
+def start_metrics_server(port, host='0.0.0.0'):
+    global _metrics_server
+    with _lock:
+        if _metrics_server is None:
+            _metrics_server = ThreadingHTTPServer((host, port), MetricsHandler)
+            threading.Thread(target=_metrics_server.serve_forever, daemon=True).start()
+    return _metrics_server
+
+# Show the spans of the last request in an optional Streamlit debug panel
+def render_debug_panel(spans):
+    import pandas as pd
+    import streamlit as st
+
+    with st.expander('Debug: stage timings', expanded=True):
+        if not spans:
+            st.write("No spans recorded yet.")
+            return
+        df = pd.DataFrame(spans).drop(columns=['timestamp'])
+        st.dataframe(df)
+        st.write(df.groupby('stage')['seconds'].sum().sort_values(ascending=False))
+        st.download_button("Download spans (JSON)", json.dumps(spans, indent=2), "spans.json", "application/json", key='download-spans')
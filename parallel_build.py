@@ -0,0 +1,94 @@
+import json
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Features per chunk sent to a worker
+DEFAULT_CHUNK_SIZE = 2000
+
+# Below this many features the pool costs more than it saves
+DEFAULT_PARALLEL_THRESHOLD = 2000
+
+# How the geometries of a chunk travel: concatenated WKB, or GeoJSON text
+ENCODING_WKB = 'wkb'
+ENCODING_GEOJSON = 'geojson'
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# Transformers of a worker process, one per source SRID
+_transformers = {}
+
+# The process pool shared by every session; workers are spawned rather than forked,
+# the Streamlit server process runs threads that must not be copied into children
+def get_pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=workers or os.cpu_count(),
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+        return _pool
+
+# A chunk of features of one table and SRID, packed for the trip to a worker:
+# WKB concatenated into one buffer with the length of each geometry, and the popup
+# attributes as one JSON document of rows
+def pack_chunk(table_name, srid, geometries, rows):
+    if geometries and isinstance(geometries[0], str):
+        payload, lengths, encoding = list(geometries), None, ENCODING_GEOJSON
+    else:
+        import shapely
+
+        wkbs = shapely.to_wkb(geometries)
+        payload, lengths, encoding = b''.join(wkbs), [len(wkb) for wkb in wkbs], ENCODING_WKB
+    return table_name, int(srid), encoding, payload, lengths, json.dumps(rows, default=str)
+
+def unpack_geometries(encoding, payload, lengths):
+    import shapely
+
+    if encoding == ENCODING_GEOJSON:
+        return shapely.from_geojson(payload)
+    buffer = memoryview(payload)
+    parts, offset = [], 0
+    for length in lengths:
+        parts.append(bytes(buffer[offset:offset + length]))
+        offset += length
+    return shapely.from_wkb(parts)
+
+def reproject(geometries, srid):
+    import numpy as np
+    import pyproj
+    import shapely
+
+    if srid == 4326:
+        return geometries
+    if srid not in _transformers:
+        _transformers[srid] = pyproj.Transformer.from_crs(f"EPSG:{srid}", "EPSG:4326", always_xy=True)
+    transformer = _transformers[srid]
+    return shapely.transform(geometries, lambda coords: np.column_stack(transformer.transform(coords[:, 0], coords[:, 1])))
+
+# Popup HTML of one feature, as add_geometries_to_map builds it
+def popup_html(table_name, attributes):
+    return f"<b>Table: {table_name}</b><br>" + "<br>".join(
+        [f"<b>{key}:</b> {value}" for key, value in attributes.items() if value is not None and value != '']
+    )
+
+# Worker: decode, reproject and build the popups of a chunk, returning
+# (table_name, GeoJSON FeatureCollection text, feature count)
+def build_fragment(chunk):
+    import shapely
+
+    table_name, srid, encoding, payload, lengths, rows = chunk
+    geometries = reproject(unpack_geometries(encoding, payload, lengths), srid)
+    features = [
+        '{"type": "Feature", "geometry": ' + geometry + ', "properties": '
+        + json.dumps({'popup': popup_html(table_name, attributes)}) + '}'
+        for geometry, attributes in zip(shapely.to_geojson(geometries), json.loads(rows))
+    ]
+    return table_name, '{"type": "FeatureCollection", "features": [' + ', '.join(features) + ']}', len(features)
+
+# Build the fragments of every chunk across the pool, yielding them as they complete in order
+def build_fragments(chunks, workers=None):
+    return get_pool(workers).map(build_fragment, chunks)
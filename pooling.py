@@ -0,0 +1,81 @@
+import hashlib
+import threading
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+# Connections kept open per process, shared by every session's worker threads
+DEFAULT_POOL_SIZE = 20
+
+# Seconds to wait for a free connection before giving up
+DEFAULT_POOL_TIMEOUT = 30.0
+
+# Parameters every prepared statement declares, in order, whether it uses them or not
+PARAMETERS = (('polygon', 'text'), ('srid', 'integer'))
+
+# A connection that remembers the statements prepared on it
+class PreparingConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+# A thread-safe pool that blocks while every connection is in use, instead of failing
+class ConnectionPool:
+    def __init__(self, size, connect_kwargs, timeout=DEFAULT_POOL_TIMEOUT):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(0, size, connection_factory=PreparingConnection, **connect_kwargs)
+        self.slots = threading.BoundedSemaphore(size)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self.slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError('no free connection in the pool')
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    # Return a connection with its transaction rolled back, which also undoes any SET done
+    # in it; prepared statements outlive the rollback. Broken connections are closed.
+    def putconn(self, conn):
+        try:
+            broken = conn.closed or conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+            if not broken:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    broken = True
+            self.pool.putconn(conn, close=bool(broken))
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+_pool = None
+_lock = threading.Lock()
+
+# The process-wide pool, created on first use
+def get_pool(connect_kwargs, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT):
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ConnectionPool(size, connect_kwargs, timeout)
+        return _pool
+
+# Position ($n) of a parameter inside prepared statements
+def parameter_index(name):
+    return [parameter for parameter, _ in PARAMETERS].index(name) + 1
+
+# Prepare a statement on a pooled connection once, named after its text, and return the
+# EXECUTE statement that runs it with psycopg2 named parameters. Statements use $n placeholders.
+def prepare(conn, statement):
+    text = statement.as_string(conn)
+    name = 'map_' + hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+    if name not in conn.prepared:
+        types = ', '.join(parameter_type for _, parameter_type in PARAMETERS)
+        with conn.cursor() as cursor:
+            cursor.execute(f'PREPARE {name} ({types}) AS {text};')
+        conn.prepared.add(name)
+    return f"EXECUTE {name} ({', '.join(f'%({parameter})s' for parameter, _ in PARAMETERS)});"
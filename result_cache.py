@@ -0,0 +1,197 @@
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import instrumentation
+import table_changes
+
+# Memory held by cached results, in megabytes
+DEFAULT_MEMORY_LIMIT_MB = 256
+
+# Rough bytes per geometry coordinate and per geometry object, for sizing decoded results
+COORDINATE_BYTES = 16
+GEOMETRY_OVERHEAD = 100
+
+# Per-table results shared by every session of the process. An entry remembers the change
+# counters its table had when it was stored and is only served while they are unchanged; the
+# least recently used entries are evicted beyond the memory limit. Tables without counters
+# (views, or tables not in pg_stat_user_tables yet) are never cached. With a directory, entries
+# are also pickled to disk, where other processes and restarts find them; unpickling runs
+# whatever a file holds, so the directory must be private to the user running the app.
+class ResultCache:
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT_MB * 2 ** 20, directory=None, disk_limit=None):
+        self.memory_limit = memory_limit
+        self.directory = directory
+        self.disk_limit = disk_limit
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.changes = table_changes.ChangeCounters()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'invalidations': 0}
+        self.lock = threading.RLock()
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+            check_private(directory)
+
+    def refresh_counters(self, get_connection, interval=table_changes.DEFAULT_CHECK_INTERVAL):
+        self.changes.refresh(get_connection, interval)
+
+    # Counters of a table as last read; taken before querying it and passed to put()
+    def counter(self, table_name):
+        return self.changes.get(table_name)
+
+    # The cached value, or None. Without count_miss a miss is left out of the stats, for lookups
+    # that can only hit in some cases; the caller records it with miss() once it is known it
+    # could have hit.
+    def get(self, key, count_miss=True):
+        table_name = key[0]
+        current = self.changes.get(table_name)
+        with self.lock:
+            if current is None:
+                self.stats['misses'] += count_miss
+                return None
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] == current:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[1]
+                self.discard(key)
+                self.stats['invalidations'] += 1
+
+        entry = self.read_disk(key)
+        with self.lock:
+            if entry is not None and entry[0] == current:
+                self.stats['hits'] += 1
+                self.store_memory(key, entry)
+                return entry[1]
+            self.stats['misses'] += count_miss
+        return None
+
+    def miss(self):
+        with self.lock:
+            self.stats['misses'] += 1
+
+    def put(self, key, value, size, counter):
+        if counter is None:
+            return
+        entry = (counter, value, size)
+        with self.lock:
+            self.stats['stores'] += 1
+            self.store_memory(key, entry)
+        self.write_disk(key, entry)
+
+    def store_memory(self, key, entry):
+        if entry[2] > self.memory_limit:
+            return
+        self.discard(key)
+        self.entries[key] = entry
+        self.bytes += entry[2]
+        while self.bytes > self.memory_limit:
+            oldest = next(iter(self.entries))
+            self.discard(oldest)
+            self.stats['evictions'] += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def disk_path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self.disk_path(key), 'rb') as f:
+                stored_key, entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        return entry if stored_key == key else None
+
+    # Write an entry atomically, then trim the directory to its limit, oldest files first
+    def write_disk(self, key, entry):
+        if not self.directory:
+            return
+        path = self.disk_path(key)
+        temporary = f'{path}.{os.getpid()}.tmp'
+        with open(temporary, 'wb') as f:
+            pickle.dump((key, entry), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, path)
+        if not self.disk_limit:
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(self.directory, name)))
+        total = sum(size for _, size, _ in files)
+        for _, size, name in sorted(files):
+            if total <= self.disk_limit:
+                break
+            total -= size
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def metrics(self):
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(
+                self.stats,
+                entries=len(self.entries),
+                bytes=self.bytes,
+                hit_rate=self.stats['hits'] / lookups if lookups else 0.0,
+            )
+
+# Refuse a cache directory other users could write pickles into
+def check_private(directory):
+    stat = os.stat(directory)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError(f"{directory} must be owned by this user and not writable by group or others")
+
+# Approximate memory of a query result: the frame itself plus its decoded geometries
+def result_size(df):
+    import shapely
+
+    size = int(df.memory_usage(deep=True).sum())
+    if 'geometry' in df.columns and len(df) and not isinstance(df['geometry'].iloc[0], str):
+        size += int(shapely.get_num_coordinates(df['geometry'].values).sum()) * COORDINATE_BYTES
+        size += len(df) * GEOMETRY_OVERHEAD
+    return size
+
+_cache = None
+_lock = threading.Lock()
+
+# The process-wide cache, created on first use
+def get_cache(memory_limit_mb=DEFAULT_MEMORY_LIMIT_MB, directory=None, disk_limit_mb=None):
+    global _cache
+    with _lock:
+        if _cache is None:
+            _cache = ResultCache(
+                memory_limit_mb * 2 ** 20, directory, disk_limit_mb * 2 ** 20 if disk_limit_mb else None
+            )
+            instrumentation.register_collector(render_prometheus)
+        return _cache
+
+# Metrics of the process-wide cache, None before it is created
+def metrics():
+    return _cache.metrics() if _cache is not None else None
+
+# Cache metrics in the Prometheus text exposition format
+def render_prometheus():
+    if _cache is None:
+        return ''
+    metrics = _cache.metrics()
+    lines = []
+    for name in ('hits', 'misses', 'stores', 'evictions', 'invalidations'):
+        lines += [f'# TYPE result_cache_{name}_total counter', f'result_cache_{name}_total {metrics[name]}']
+    for name in ('entries', 'bytes', 'hit_rate'):
+        lines += [f'# TYPE result_cache_{name} gauge', f'result_cache_{name} {metrics[name]}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+
+import psycopg2
+from psycopg2 import sql
+
+import core
+from core import lazy_import
+
+pd = lazy_import('pandas')
+
+# Sync state of every table: change counters and the watermark the next sync fetches from
+STATE_FILE = '_state.json'
+
+# The mirrored metadata table
+METADATA_FILE = 'metadata.parquet'
+
+# Rows per row group; each row group's bbox statistics let reads skip it for far away polygons
+ROW_GROUP_SIZE = 10000
+
+# Rows are sorted into horizontal bands of this height (degrees) before writing,
+# so that row groups cover compact areas
+SORT_BAND = 0.1
+
+# Fields of the bbox struct column GeoParquet readers (and snapshot_query) filter on
+BBOX_FIELDS = ('xmin', 'ymin', 'xmax', 'ymax')
+
+# Columns added by the snapshot next to the table's own columns, with the bbox read as flat columns
+SNAPSHOT_COLUMNS = ('ctid', 'geometry') + BBOX_FIELDS
+
+def table_path(path, table_name):
+    return os.path.join(path, f'{table_name}.parquet')
+
+def load_state(path):
+    state_path = os.path.join(path, STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+def save_state(path, state):
+    with open(os.path.join(path, STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+# SHAPE tables to mirror; views are left out, their rows have no ctid to sync by
+def list_tables(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.table_name FROM information_schema.columns c
+            JOIN information_schema.tables t ON t.table_schema = c.table_schema AND t.table_name = c.table_name
+            WHERE c.column_name = 'SHAPE' AND c.table_schema = 'public' AND t.table_type = 'BASE TABLE';
+        """)
+        return [row[0] for row in cursor.fetchall()]
+
+def list_columns(conn, table_name):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = 'public';",
+            (table_name,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+# Geometries are stored in EPSG:4326, reprojected once at sync time from the table's srid
+# column, or from the metadata srid of its layer when the table has none
+def table_geometry_expression(conn, table_name, columns):
+    if 'srid' in columns:
+        return core.shape_4326()
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT layer_name, srid FROM metadata;')
+        layers = dict(cursor.fetchall())
+    layer_name = core.create_table_to_layer_mapping([table_name], list(layers)).get(table_name)
+    if layer_name is None or layers[layer_name] is None:
+        return None
+    return core.shape_4326(int(layers[layer_name]))
+
+# Fetch the rows of a table written since the watermark (every row without it): its columns
+# but "SHAPE", the ctid and the geometry as WKB in EPSG:4326
+def fetch_changed_rows(conn, table_name, columns, geometry_expression, watermark=None):
+    import spatial_index
+
+    select = [
+        sql.SQL('drawing_info::text AS drawing_info') if column == 'drawing_info' else sql.Identifier(column)
+        for column in columns if column != 'SHAPE'
+    ]
+    where = sql.SQL('"SHAPE" IS NOT NULL')
+    if watermark is not None:
+        where = sql.SQL('{} AND {}').format(where, spatial_index.written_since(watermark))
+    query = sql.SQL("""
+        SELECT {select}, ctid::text AS ctid, ST_AsBinary({geometry}) AS geometry
+        FROM {table}
+        WHERE {where};
+    """).format(
+        select=sql.SQL(', ').join(select),
+        geometry=sql.SQL(geometry_expression),
+        table=sql.Identifier('public', table_name),
+        where=where,
+    )
+    df = pd.read_sql(query.as_string(conn), conn)
+    df['geometry'] = [bytes(value) if value is not None else None for value in df['geometry']]
+    return df
+
+# Add the bbox of every geometry, as flat columns until the table is written
+def add_bounds(df):
+    import shapely
+
+    bounds = shapely.bounds(shapely.from_wkb(df['geometry']))
+    df['xmin'], df['ymin'], df['xmax'], df['ymax'] = bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]
+    return df
+
+# Write a table as GeoParquet, sorted into bands so row groups cover compact areas. The bbox
+# columns become the fields of a bbox struct column, the GeoParquet 1.1 covering; the CRS is
+# left out, which GeoParquet reads as EPSG:4326.
+def write_table(df, path):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.assign(band=(df['ymin'] // SORT_BAND)).sort_values(['band', 'xmin']).drop(columns=['band'])
+    geo_metadata = {
+        'version': '1.1.0',
+        'primary_column': 'geometry',
+        'columns': {'geometry': {
+            'encoding': 'WKB',
+            'geometry_types': [],
+            'covering': {'bbox': {name: ['bbox', name] for name in BBOX_FIELDS}},
+        }},
+    }
+    table = pa.Table.from_pandas(df.drop(columns=list(BBOX_FIELDS)), preserve_index=False)
+    bbox = pa.StructArray.from_arrays(
+        [pa.array(df[name].to_numpy(), pa.float64()) for name in BBOX_FIELDS], names=list(BBOX_FIELDS)
+    )
+    table = table.append_column('bbox', bbox)
+    table = table.replace_schema_metadata(dict(table.schema.metadata or {}, geo=json.dumps(geo_metadata)))
+    pq.write_table(table, path + '.tmp', row_group_size=ROW_GROUP_SIZE)
+    os.replace(path + '.tmp', path)
+
+# Read a snapshot table, with the fields of its bbox struct as flat columns. Filters are a
+# pyarrow expression; row groups whose statistics rule it out are not read.
+def read_table(path, filters=None):
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path, filters=filters)
+    bbox = table.column('bbox').combine_chunks()
+    df = table.drop(['bbox']).to_pandas()
+    for name in BBOX_FIELDS:
+        df[name] = bbox.field(name).to_numpy(zero_copy_only=False)
+    return df
+
+# Bring one table's snapshot up to date. Without a previous sync every row is copied; otherwise
+# rows written since the watermark taken at the start of the last sync (inserted or updated)
+# are fetched, and rows whose ctid disappeared (deleted, or replaced by an update) are dropped.
+# A table without change counters is copied in full every time. Returns the table's new sync state.
+def sync_table(conn, path, table_name, table_state):
+    import spatial_index
+
+    columns = list_columns(conn, table_name)
+    geometry_expression = table_geometry_expression(conn, table_name, columns)
+    if geometry_expression is None:
+        print(f"  {table_name}: skipped, no srid column and no metadata srid")
+        return None
+
+    changes = spatial_index.change_counters(conn, table_name)
+    changes = None if changes is None else list(changes)
+    watermark = spatial_index.current_watermark(conn)
+    output = table_path(path, table_name)
+    # States written before the watermark was recorded are synced from scratch
+    if (table_state and os.path.exists(output) and table_state.get('columns') == columns
+            and table_state.get('watermark') is not None
+            and changes is not None and table_state.get('changes') is not None):
+        if changes == table_state['changes']:
+            print(f"  {table_name}: unchanged")
+            return table_state
+        existing = read_table(output)
+        new_rows = fetch_changed_rows(conn, table_name, columns, geometry_expression, table_state['watermark'])
+        if changes[1] != table_state['changes'][1] or changes[2] != table_state['changes'][2]:
+            live = spatial_index.live_ctids(conn, table_name)
+            existing = existing[existing['ctid'].isin(live)]
+        existing = existing[~existing['ctid'].isin(new_rows['ctid'])]
+        df = pd.concat([existing, add_bounds(new_rows)], ignore_index=True)
+        print(f"  {table_name}: {len(new_rows)} changed rows, {len(df)} rows")
+    else:
+        df = add_bounds(fetch_changed_rows(conn, table_name, columns, geometry_expression))
+        print(f"  {table_name}: {len(df)} rows")
+
+    write_table(df, output)
+    return {'columns': columns, 'changes': changes, 'watermark': watermark}
+
+# Mirror every SHAPE table and the metadata table into a snapshot directory
+def sync(conn, path):
+    os.makedirs(path, exist_ok=True)
+    state = load_state(path)
+    tables = list_tables(conn)
+
+    metadata = pd.read_sql('SELECT * FROM metadata;', conn)
+    if 'drawing_info' in metadata.columns:
+        metadata['drawing_info'] = [
+            value if value is None or isinstance(value, str) else json.dumps(value) for value in metadata['drawing_info']
+        ]
+    metadata.to_parquet(os.path.join(path, METADATA_FILE), index=False)
+    synced = set()
+    for table_name in tables:
+        try:
+            table_state = sync_table(conn, path, table_name, state.get(table_name))
+        except Exception as e:
+            # The table keeps its previous snapshot, if any, and the other tables still sync
+            print(f"  {table_name}: failed, {e}")
+            table_state = state.get(table_name)
+        conn.rollback()
+        if table_state is not None:
+            state[table_name] = table_state
+            synced.add(table_name)
+
+    # Tables dropped from the database (or skipped) leave the snapshot too
+    for table_name in set(state) - synced:
+        del state[table_name]
+        if os.path.exists(table_path(path, table_name)):
+            os.remove(table_path(path, table_name))
+    save_state(path, state)
+
+# Tables in a snapshot
+def snapshot_tables(path):
+    return sorted(load_state(path))
+
+# Columns of a table as in the database, without the ones the snapshot adds
+def snapshot_columns(path, table_name):
+    return load_state(path).get(table_name, {}).get('columns', [])
+
+def snapshot_metadata(path):
+    return pd.read_parquet(os.path.join(path, METADATA_FILE))
+
+# Rows of a table intersecting a GeoJSON polygon (every row without one), shaped like the
+# results of a database query: the table's columns, geometry decoded in EPSG:4326 and srid 4326.
+# Row groups whose bbox statistics miss the polygon are not read.
+def snapshot_query(path, table_name, polygon_geojson=None):
+    import pyarrow.compute as pc
+    import shapely
+
+    filters = None
+    polygon = None
+    if polygon_geojson is not None:
+        polygon = shapely.from_geojson(polygon_geojson)
+        west, south, east, north = polygon.bounds
+        filters = (
+            (pc.field('bbox', 'xmax') >= west) & (pc.field('bbox', 'xmin') <= east)
+            & (pc.field('bbox', 'ymax') >= south) & (pc.field('bbox', 'ymin') <= north)
+        )
+    df = read_table(table_path(path, table_name), filters)
+
+    df['geometry'] = shapely.from_wkb(df['geometry'])
+    if polygon is not None:
+        df = df[shapely.intersects(df['geometry'].values, polygon)]
+    df = df.drop(columns=[column for column in SNAPSHOT_COLUMNS if column != 'geometry'])
+    df['srid'] = 4326
+    return df.reset_index(drop=True)
+
+def main():
+    parser = argparse.ArgumentParser(description='Mirror the SHAPE tables and the metadata table into a local GeoParquet snapshot.')
+    parser.add_argument('--dsn', default='', help='libpq connection string, defaults to the PG* environment variables')
+    parser.add_argument('--path', default='snapshot', help='snapshot directory, created if missing')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(args.dsn)
+    try:
+        print(f"Syncing into {args.path}")
+        sync(conn, args.path)
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
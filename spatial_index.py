@@ -0,0 +1,198 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from psycopg2 import sql
+
+import instrumentation
+
+# Seconds between two checks of a table's change counters
+DEFAULT_REFRESH_INTERVAL = 30.0
+
+# One table's geometries held in memory: row keys (ctid), bounds and WKB in EPSG:4326,
+# and a packed STRtree over the bounds
+class LayerIndex:
+    def __init__(self, table_name, geometry_expression, ctids, wkbs, changes, watermark):
+        import shapely
+
+        self.table_name = table_name
+        self.geometry_expression = geometry_expression
+        self.ctids = np.asarray(ctids, dtype=object)
+        self.wkbs = np.asarray(wkbs, dtype=object)
+        geometries = shapely.from_wkb(self.wkbs) if len(self.wkbs) else np.empty(0, dtype=object)
+        self.bounds = shapely.bounds(geometries) if len(geometries) else np.empty((0, 4))
+        # The tree holds boxes only; candidates are decoded from WKB for the exact test
+        self.tree = shapely.STRtree(shapely.box(*self.bounds.T) if len(self.bounds) else [])
+        self.changes = changes
+        self.watermark = watermark
+        self.checked_at = time.monotonic()
+
+    # Rows whose geometry intersects a shapely polygon: (ctids, geometries)
+    def query(self, polygon):
+        import shapely
+
+        candidates = self.tree.query(polygon)
+        geometries = shapely.from_wkb(self.wkbs[candidates])
+        hits = shapely.intersects(geometries, polygon)
+        return self.ctids[candidates][hits], geometries[hits]
+
+    # Approximate memory held by the index, in bytes
+    def footprint(self):
+        wkb_bytes = sum(len(wkb) for wkb in self.wkbs)
+        key_bytes = sum(len(ctid) for ctid in self.ctids)
+        # Each box in the tree is a small GEOS polygon of 5 coordinates
+        tree_bytes = len(self.bounds) * 200
+        return wkb_bytes + key_bytes + self.bounds.nbytes + tree_bytes
+
+_indexes = {}
+_pending = set()
+_failed_at = {}
+_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='spatial-index')
+
+# Insert, update and delete counters of a table; they only grow, so any difference means a change.
+# None when the statistics have no entry for it (a view, or a missing table): changes unknown.
+def change_counters(conn, table_name):
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT n_tup_ins, n_tup_upd, n_tup_del FROM pg_stat_user_tables WHERE schemaname = 'public' AND relname = %s;",
+            (table_name,),
+        )
+        row = cursor.fetchone()
+    return tuple(row) if row else None
+
+# Oldest transaction still running, as a 64-bit id that does not wrap around. Transaction ids
+# are assigned when a transaction starts, so rows committed after this point may carry any id
+# from it on; syncing from it again next time cannot miss them.
+def current_watermark(conn):
+    with conn.cursor() as cursor:
+        cursor.execute('SELECT txid_snapshot_xmin(txid_current_snapshot());')
+        return int(cursor.fetchone()[0])
+
+# Condition for rows written by a transaction at or after a watermark. xmin is a 32-bit id
+# that wraps around, so both are compared by their age relative to the current transaction.
+def written_since(watermark):
+    return sql.SQL('age(xmin) <= age({}::xid)').format(sql.Literal(str(int(watermark) % 2 ** 32)))
+
+# Fetch (ctid, WKB in EPSG:4326) of the rows, only those written since the watermark when given
+def fetch_rows(conn, table_name, geometry_expression, watermark=None):
+    where = sql.SQL('"SHAPE" IS NOT NULL')
+    if watermark is not None:
+        where = sql.SQL('{} AND {}').format(where, written_since(watermark))
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL("""
+            SELECT ctid::text, ST_AsBinary({geometry})
+            FROM {table}
+            WHERE {where};
+        """).format(geometry=sql.SQL(geometry_expression), table=sql.Identifier('public', table_name), where=where))
+        return [(ctid, bytes(wkb)) for ctid, wkb in cursor.fetchall()]
+
+# ctids of every row of a table
+def live_ctids(conn, table_name):
+    with conn.cursor() as cursor:
+        cursor.execute(sql.SQL('SELECT ctid::text FROM {};').format(sql.Identifier('public', table_name)))
+        return {row[0] for row in cursor.fetchall()}
+
+# Load a table's index from scratch
+def load_index(conn, table_name, geometry_expression):
+    changes = change_counters(conn, table_name)
+    watermark = current_watermark(conn)
+    rows = fetch_rows(conn, table_name, geometry_expression)
+    return LayerIndex(
+        table_name, geometry_expression, [row[0] for row in rows], [row[1] for row in rows], changes, watermark,
+    )
+
+# Bring an index up to date: rows written since the last watermark are fetched and replace any
+# entry at the same ctid (VACUUM lets a new row reuse the slot of a deleted one), and rows
+# whose ctid disappeared (deleted, or replaced by a newer version on update) are dropped
+def refresh_index(conn, index, geometry_expression):
+    changes = change_counters(conn, index.table_name)
+    # Without counters nothing tells which rows changed, so the table is loaded again
+    if changes is None or index.changes is None:
+        return load_index(conn, index.table_name, geometry_expression)
+    if changes == index.changes:
+        index.checked_at = time.monotonic()
+        return index
+
+    watermark = current_watermark(conn)
+    new_rows = fetch_rows(conn, index.table_name, geometry_expression, index.watermark)
+    ctids, wkbs = list(index.ctids), list(index.wkbs)
+    if changes[1] != index.changes[1] or changes[2] != index.changes[2]:
+        live = live_ctids(conn, index.table_name)
+        kept = [(ctid, wkb) for ctid, wkb in zip(ctids, wkbs) if ctid in live]
+        ctids, wkbs = [row[0] for row in kept], [row[1] for row in kept]
+
+    replaced = {row[0] for row in new_rows}
+    kept = [(ctid, wkb) for ctid, wkb in zip(ctids, wkbs) if ctid not in replaced]
+    ctids = [row[0] for row in kept] + [row[0] for row in new_rows]
+    wkbs = [row[1] for row in kept] + [row[1] for row in new_rows]
+    return LayerIndex(index.table_name, geometry_expression, ctids, wkbs, changes, watermark)
+
+# True when an index can answer without going back to the database
+def is_fresh(index, geometry_expression, refresh_interval):
+    return (
+        index is not None
+        and index.geometry_expression == geometry_expression
+        and time.monotonic() - index.checked_at < refresh_interval
+    )
+
+# The up-to-date index of a table; otherwise None, and it is loaded or refreshed in the
+# background on a connection of its own, free of any query's statement timeout, while the
+# caller queries the table in SQL. A table whose index failed to load (a view has no ctid) is
+# tried again after refresh_interval. The geometry expression differs between SRID sources,
+# so an index built with another one is reloaded.
+def get_index(get_connection, table_name, geometry_expression, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+    with _lock:
+        index = _indexes.get(table_name)
+        if is_fresh(index, geometry_expression, refresh_interval):
+            return index
+        failed_at = _failed_at.get(table_name)
+        if table_name in _pending or (failed_at is not None and time.monotonic() - failed_at < refresh_interval):
+            return None
+        _pending.add(table_name)
+    _executor.submit(build_index, get_connection, table_name, geometry_expression)
+    return None
+
+# Load or refresh a table's index and publish it
+def build_index(get_connection, table_name, geometry_expression):
+    try:
+        conn = get_connection()
+        if conn is None:
+            raise RuntimeError('no database connection')
+        try:
+            with _lock:
+                index = _indexes.get(table_name)
+            if index is None or index.geometry_expression != geometry_expression:
+                index = load_index(conn, table_name, geometry_expression)
+            else:
+                index = refresh_index(conn, index, geometry_expression)
+        finally:
+            conn.close()
+        with _lock:
+            _indexes[table_name] = index
+            _failed_at.pop(table_name, None)
+    except Exception as e:
+        instrumentation.logger.warning(f"Could not build the spatial index of table {table_name}: {e}")
+        with _lock:
+            _failed_at[table_name] = time.monotonic()
+    finally:
+        with _lock:
+            _pending.discard(table_name)
+
+# Drop the index of a table, or of every table
+def clear(table_name=None):
+    with _lock:
+        if table_name is None:
+            _indexes.clear()
+            _failed_at.clear()
+        else:
+            _indexes.pop(table_name, None)
+            _failed_at.pop(table_name, None)
+
+# Rows and memory footprint of every loaded index
+def footprints():
+    return [
+        {'table': table_name, 'rows': len(index.ctids), 'bytes': index.footprint()}
+        for table_name, index in sorted(_indexes.items())
+    ]
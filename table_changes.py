@@ -0,0 +1,40 @@
+import threading
+import time
+
+# Seconds between two reads of the tables' change counters
+DEFAULT_CHECK_INTERVAL = 5.0
+
+# Change counters (inserts + updates + deletes) of every table, read in one query at most once
+# per interval; statistics reach pg_stat_user_tables within about a second of a commit.
+# A relation without a row there (a view, or a table not reported yet) has no counter: whether
+# it changed is unknown, and nothing derived from it should be trusted.
+class ChangeCounters:
+    def __init__(self):
+        self.counters = {}
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def refresh(self, get_connection, interval=DEFAULT_CHECK_INTERVAL):
+        with self.lock:
+            if time.monotonic() - self.checked_at < interval:
+                return
+            self.checked_at = time.monotonic()
+        conn = get_connection()
+        if conn is None:
+            return
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    SELECT relname, n_tup_ins + n_tup_upd + n_tup_del
+                    FROM pg_stat_user_tables WHERE schemaname = 'public';
+                """)
+                counters = dict(cursor.fetchall())
+        finally:
+            conn.close()
+        with self.lock:
+            self.counters = counters
+
+    # Counter of a table as last read, None when unknown
+    def get(self, table_name):
+        with self.lock:
+            return self.counters.get(table_name)
@@ -0,0 +1,38 @@
+import types
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+shapely = pytest.importorskip('shapely')
+pytest.importorskip('streamlit')
+pytest.importorskip('psycopg2')
+
+import core
+
+class SessionState(dict):
+    __getattr__ = dict.__getitem__
+    __setattr__ = dict.__setitem__
+
+@pytest.fixture
+def session(monkeypatch):
+    state = SessionState(table_columns={'parcels': ['id', 'name', 'SHAPE']})
+    monkeypatch.setattr(core, 'st', types.SimpleNamespace(session_state=state))
+    return state
+
+# A batch query tags its features for the popups; the next query of the same table must still
+# select only the table's own columns
+def test_batch_then_normal_query(session):
+    df = pd.DataFrame({
+        'id': [1, 2], 'name': ['a', 'b'], 'table_name': ['parcels', 'parcels'], 'srid': [4326, 4326],
+        'geometry': [shapely.Point(0.5, 0.5), shapely.Point(5, 5)],
+    })
+    areas = [('north', shapely.box(0, 0, 1, 1)), ('south', shapely.box(0, 0, 2, 2))]
+
+    core.tag_matched_areas(df, areas)
+
+    assert df['matched_areas'].tolist() == ['north, south', '']
+    assert core.cached_table_columns('parcels') == ['id', 'name', 'SHAPE']
+    assert core.popup_columns()['parcels'] == ['id', 'name', 'SHAPE', 'matched_areas']
+
+    core.tag_matched_areas(df, areas)
+    assert core.popup_columns()['parcels'] == ['id', 'name', 'SHAPE', 'matched_areas']
@@ -0,0 +1,28 @@
+import result_cache
+
+def make_cache():
+    cache = result_cache.ResultCache()
+    cache.changes.counters = {'parcels': 7}
+    return cache
+
+def test_get_counts_hits_and_misses():
+    cache = make_cache()
+    key = ('parcels', 'features')
+
+    assert cache.get(key) is None
+    cache.put(key, 'rows', 10, 7)
+    assert cache.get(key) == 'rows'
+    assert (cache.stats['hits'], cache.stats['misses']) == (1, 1)
+
+# Aggregate lookups of tables small enough to fetch always miss; they are only counted once the
+# table turns out to be aggregated
+def test_lookup_without_count_miss():
+    cache = make_cache()
+    key = ('parcels', 'aggregate')
+
+    assert cache.get(key, count_miss=False) is None
+    assert cache.stats['misses'] == 0
+    cache.miss()
+    cache.put(key, (100, {}), 10, 7)
+    assert cache.get(key, count_miss=False) == (100, {})
+    assert (cache.stats['hits'], cache.stats['misses']) == (1, 1)
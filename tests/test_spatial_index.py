@@ -0,0 +1,99 @@
+import pytest
+
+shapely = pytest.importorskip('shapely')
+
+import spatial_index
+
+def make_index(rows, changes):
+    return spatial_index.LayerIndex(
+        'parcels', 'geometry', [ctid for ctid, _ in rows], [shapely.to_wkb(geometry) for _, geometry in rows], changes, 100,
+    )
+
+# A row is deleted, VACUUM frees its slot and an insert reuses the ctid before the next refresh:
+# the new row replaces the old entry instead of being dropped as already known
+def test_refresh_replaces_reused_ctid(monkeypatch):
+    index = make_index([('(0,1)', shapely.Point(0, 0)), ('(0,2)', shapely.Point(1, 1))], (2, 0, 0))
+    new_point = shapely.Point(10, 10)
+    monkeypatch.setattr(spatial_index, 'change_counters', lambda conn, table_name: (3, 0, 1))
+    monkeypatch.setattr(spatial_index, 'current_watermark', lambda conn: 102)
+    monkeypatch.setattr(spatial_index, 'live_ctids', lambda conn, table_name: {'(0,1)', '(0,2)'})
+    monkeypatch.setattr(
+        spatial_index, 'fetch_rows', lambda *args, **kwargs: [('(0,1)', shapely.to_wkb(new_point))]
+    )
+
+    refreshed = spatial_index.refresh_index(None, index, 'geometry')
+
+    assert sorted(refreshed.ctids.tolist()) == ['(0,1)', '(0,2)']
+    assert refreshed.watermark == 102
+    ctids, geometries = refreshed.query(shapely.box(9, 9, 11, 11))
+    assert ctids.tolist() == ['(0,1)']
+    assert geometries[0].equals(new_point)
+    assert not len(refreshed.query(shapely.box(-1, -1, 0.5, 0.5))[0])
+
+def test_refresh_drops_deleted_rows(monkeypatch):
+    index = make_index([('(0,1)', shapely.Point(0, 0)), ('(0,2)', shapely.Point(1, 1))], (2, 0, 0))
+    monkeypatch.setattr(spatial_index, 'change_counters', lambda conn, table_name: (2, 0, 1))
+    monkeypatch.setattr(spatial_index, 'current_watermark', lambda conn: 102)
+    monkeypatch.setattr(spatial_index, 'live_ctids', lambda conn, table_name: {'(0,2)'})
+    monkeypatch.setattr(spatial_index, 'fetch_rows', lambda *args, **kwargs: [])
+
+    refreshed = spatial_index.refresh_index(None, index, 'geometry')
+
+    assert refreshed.ctids.tolist() == ['(0,2)']
+
+# Without counters (no statistics entry) changes are unknown, so the table is loaded again
+def test_refresh_without_counters_reloads(monkeypatch):
+    index = make_index([('(0,1)', shapely.Point(0, 0))], (1, 0, 0))
+    reloaded = make_index([('(0,3)', shapely.Point(5, 5))], None)
+    monkeypatch.setattr(spatial_index, 'change_counters', lambda conn, table_name: None)
+    monkeypatch.setattr(spatial_index, 'load_index', lambda conn, table_name, geometry_expression: reloaded)
+
+    assert spatial_index.refresh_index(None, index, 'geometry') is reloaded
+
+class DeferredExecutor:
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, fn, *args):
+        self.calls.append((fn, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for fn, args in calls:
+            fn(*args)
+
+class FakeConnection:
+    def close(self):
+        pass
+
+# The first query of a table falls back to SQL while its index loads in the background
+def test_get_index_loads_in_background(monkeypatch):
+    executor = DeferredExecutor()
+    index = make_index([('(0,1)', shapely.Point(0, 0))], (1, 0, 0))
+    monkeypatch.setattr(spatial_index, '_executor', executor)
+    monkeypatch.setattr(spatial_index, 'load_index', lambda conn, table_name, geometry_expression: index)
+    spatial_index.clear()
+
+    assert spatial_index.get_index(FakeConnection, 'parcels', 'geometry') is None
+    assert spatial_index.get_index(FakeConnection, 'parcels', 'geometry') is None
+    assert len(executor.calls) == 1
+    executor.run()
+    assert spatial_index.get_index(FakeConnection, 'parcels', 'geometry') is index
+    spatial_index.clear()
+
+# A table whose index cannot be loaded, such as a view, is not retried on every query
+def test_failed_load_is_not_retried_immediately(monkeypatch):
+    executor = DeferredExecutor()
+    monkeypatch.setattr(spatial_index, '_executor', executor)
+
+    def load_index(conn, table_name, geometry_expression):
+        raise RuntimeError('column "ctid" does not exist')
+
+    monkeypatch.setattr(spatial_index, 'load_index', load_index)
+    spatial_index.clear()
+
+    assert spatial_index.get_index(FakeConnection, 'parcel_view', 'geometry') is None
+    executor.run()
+    assert spatial_index.get_index(FakeConnection, 'parcel_view', 'geometry') is None
+    assert not executor.calls
+    spatial_index.clear()
@@ -0,0 +1,138 @@
+import math
+
+from core import geometries_4326, lazy_import
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+
+# Above this many features the Auto backend draws through WebGL instead of Leaflet
+DEFAULT_WEBGL_THRESHOLD = 5000
+
+# Color used when a table's drawing_info has none, [r, g, b, a]
+DEFAULT_COLOR = [51, 136, 255, 200]
+
+# Initial view, as initialize_map
+DEFAULT_CENTER = (34.0522, -118.2437)
+DEFAULT_ZOOM = 10
+
+# Symbol and outline colors of an ArcGIS drawing_info renderer, as [r, g, b, a] lists
+def drawing_info_colors(drawing_info):
+    import json
+
+    if isinstance(drawing_info, str):
+        drawing_info = json.loads(drawing_info or '{}')
+    symbol = ((drawing_info or {}).get('renderer') or {}).get('symbol') or {}
+    color = symbol.get('color') or DEFAULT_COLOR
+    outline = (symbol.get('outline') or {}).get('color') or color
+    return list(color), list(outline)
+
+# Columnar coordinate buffers of a geometry array, one per kind: multi-part geometries are
+# exploded, and each kind becomes shapely's ragged array (coordinates and offsets) plus the
+# index of the feature every part belongs to
+def columnar_buffers(geometries):
+    import shapely
+
+    kinds = {'points': (0, 4), 'lines': (1, 5), 'polygons': (3, 6)}
+    type_ids = shapely.get_type_id(geometries)
+    buffers = {}
+    for kind, ids in kinds.items():
+        mask = np.isin(type_ids, ids)
+        if not mask.any():
+            continue
+        parts, index = shapely.get_parts(geometries[mask], return_index=True)
+        _, coords, offsets = shapely.to_ragged_array(parts, include_z=False)
+        buffers[kind] = (coords, offsets, np.flatnonzero(mask)[index])
+    return buffers
+
+# Per-part coordinate lists, as deck.gl layers take them
+def iter_parts(kind, coords, offsets):
+    if kind == 'points':
+        yield from coords.tolist()
+    elif kind == 'lines':
+        (line_offsets,) = offsets
+        for start, end in zip(line_offsets[:-1], line_offsets[1:]):
+            yield coords[start:end].tolist()
+    else:
+        ring_offsets, polygon_offsets = offsets
+        for start, end in zip(polygon_offsets[:-1], polygon_offsets[1:]):
+            yield [coords[ring_offsets[ring]:ring_offsets[ring + 1]].tolist() for ring in range(start, end)]
+
+# One deck.gl layer per table and geometry kind
+def table_layers(table_name, geometries, popups, color, fill_color):
+    import pydeck as pdk
+
+    layers = []
+    for kind, (coords, offsets, index) in columnar_buffers(geometries).items():
+        data = [
+            {'coordinates': part, 'popup': popups[feature]}
+            for part, feature in zip(iter_parts(kind, coords, offsets), index.tolist())
+        ]
+        if kind == 'points':
+            layers.append(pdk.Layer(
+                'ScatterplotLayer', data, id=f'{table_name}-points', get_position='coordinates',
+                get_fill_color=color, radius_min_pixels=3, pickable=True,
+            ))
+        elif kind == 'lines':
+            layers.append(pdk.Layer(
+                'PathLayer', data, id=f'{table_name}-lines', get_path='coordinates',
+                get_color=color, width_min_pixels=2, pickable=True,
+            ))
+        else:
+            layers.append(pdk.Layer(
+                'PolygonLayer', data, id=f'{table_name}-polygons', get_polygon='coordinates',
+                get_fill_color=fill_color, get_line_color=color, line_width_min_pixels=1, pickable=True,
+            ))
+    return layers
+
+# Grid counts of an aggregated table as a GeoJSON layer, shaded by log count
+def aggregate_layer(table_name, cells):
+    import pydeck as pdk
+
+    counts = [feature['properties']['count'] for feature in cells['features']]
+    if not counts:
+        return None
+    top = math.log1p(max(counts))
+    features = []
+    for feature in cells['features']:
+        share = math.log1p(feature['properties']['count']) / top if top else 1.0
+        features.append(dict(feature, properties={
+            'fill': [255, int(255 * (1 - share)), 0, 150],
+            'popup': f"<b>{table_name} features:</b> {feature['properties']['count']}",
+        }))
+    return pdk.Layer(
+        'GeoJsonLayer', {'type': 'FeatureCollection', 'features': features}, id=f'{table_name}-aggregate',
+        get_fill_color='properties.fill', stroked=False, pickable=True,
+    )
+
+# Build a deck.gl map of query results: features grouped by table, popups as in
+# add_geometries_to_map, and the grid counts of aggregated tables
+def build_deck(records, table_columns, aggregates=None):
+    import pydeck as pdk
+    from parallel_build import popup_html
+
+    groups = {}
+    for record in records:
+        if record.get('geometry') is None or 'srid' not in record or pd.isna(record['srid']):
+            continue
+        groups.setdefault(record['table_name'], []).append(record)
+
+    layers = [layer for layer in (aggregate_layer(table, cells) for table, cells in (aggregates or {}).items()) if layer]
+    for table_name, table_records in groups.items():
+        columns = [column for column in table_columns.get(table_name, []) if column not in ('geometry', 'SHAPE')]
+        geometries = geometries_4326([record['geometry'] for record in table_records], [record['srid'] for record in table_records])
+        popups = [
+            popup_html(table_name, {column: record.get(column) for column in columns
+                                    if column in record and pd.notna(record[column])})
+            for record in table_records
+        ]
+        color, outline = drawing_info_colors(table_records[0].get('drawing_info'))
+        fill_color = list(outline[:3]) + [min(outline[3] if len(outline) > 3 else 255, 80)]
+        layers.extend(table_layers(table_name, geometries, popups, color, fill_color))
+
+    return pdk.Deck(
+        layers=layers,
+        initial_view_state=pdk.ViewState(latitude=DEFAULT_CENTER[0], longitude=DEFAULT_CENTER[1], zoom=DEFAULT_ZOOM),
+        map_provider='carto',
+        map_style='light',
+        tooltip={'html': '{popup}'},
+    )